@@ -1,14 +1,36 @@
 from logging import DEBUG, INFO, CRITICAL, WARNING, FATAL
+from importlib import import_module
 from .localshell import LocalShell
-from .secureshell import SecureShell
-from .shellerror import ShellError
-from .shellresult import ShellResult
-from .telnetshell import TelnetShell
-from .adbshell import AdbShell
-from .serialshell import SerialShell
+from .shellerror import ShellError, ShellTimeout
+from .shellresult import ShellResult, tail
 from .shell import Shell
+from .shellpool import ShellPool
+from .shellgroup import ShellGroup, fanout
 from .parseduri import ParsedUri
+from .abstractshell import FileStat
 
 __version__ = "2.3.2"
 
-sh = Shell()
+# NOTE: the remote backends drag their transport library along (paramiko, pyserial, ...),
+#       they are imported when first accessed, and so is the default shell
+LAZY_BACKENDS = {
+    "SecureShell": ".secureshell",
+    "TelnetShell": ".telnetshell",
+    "AdbShell": ".adbshell",
+    "SerialShell": ".serialshell",
+}
+
+
+def __getattr__(name):
+    if name == "sh":
+        value = Shell()
+    elif name in LAZY_BACKENDS:
+        value = getattr(import_module(LAZY_BACKENDS[name], __name__), name)
+    else:
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_BACKENDS) + ["sh"])
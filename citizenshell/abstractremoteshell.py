@@ -1,10 +1,109 @@
-from .abstractshell import AbstractShell
+from .abstractshell import AbstractShell, FEATURE_TESTS, availability_test
 from hashlib import md5
 from time import sleep
-from binascii import hexlify, unhexlify
+from os import stat, environ, path, makedirs, replace, remove, fdopen
+from tempfile import mkstemp
+from binascii import unhexlify, a2b_base64, b2a_uu
+from base64 import encodebytes
+from string import ascii_letters, digits
+from zlib import compress, decompressobj, MAX_WBITS
+import gzip
+import json
+
+HEREDOC_MARKER = "CITIZENSHELL_EOF"
+PRINTF_SAFE_BYTES = frozenset((ascii_letters + digits).encode("ascii"))
+PULL_ENCODERS = {
+    "base64": "base64",
+    "od": "od -An -v -t x1",
+    "hexdump": "hexdump -v -C | cut -c 10-60",
+}
+
+
+def xz_compress(chunk):
+    # NOTE: python may be built without liblzma, in which case xz is never picked
+    import lzma
+    return lzma.compress(chunk, check=lzma.CHECK_CRC32, preset=1)
+
+
+def has_lzma():
+    try:
+        import lzma
+    except ImportError:
+        return False
+    return True
+
+
+# NOTE: each push block is compressed on its own, the remote decompressor
+#       reads them back as a series of concatenated members/streams
+COMPRESSORS = {
+    "xz": xz_compress,
+    "gzip": lambda chunk: gzip.compress(chunk, compresslevel=6),
+}
+COMPRESSION_MIN_SIZE = 4 * 1024
+COMPRESSION_MAX_RATIO = .9
+
+# NOTE: every tool the library might look for is probed at once when connecting
+PROBED_COMMANDS = ("base64", "chmod", "dd", "gzip", "hexdump", "ls", "md5", "md5sum",
+                   "od", "printf", "tar", "uudecode", "xz")
+FINGERPRINT_COMMAND = "echo $(uname -a; cat /proc/sys/kernel/random/boot_id 2>/dev/null; echo $PATH)"
+CAPABILITY_CACHE_PATH = path.join(environ.get("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache"),
+                                  "citizenshell", "capabilities.json")
+
+
+def load_capabilities(cache_path):
+    try:
+        with open(cache_path, "r") as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_capabilities(cache_path, key, fingerprint, commands):
+    # NOTE: the cache is shared by every process, it is rewritten as a whole and moved in place
+    try:
+        capabilities = load_capabilities(cache_path)
+        capabilities[key] = { "fingerprint": fingerprint, "commands": commands }
+        makedirs(path.dirname(cache_path), exist_ok=True)
+        fd, temp_path = mkstemp(dir=path.dirname(cache_path), prefix=path.basename(cache_path) + ".")
+        try:
+            with fdopen(fd, "w") as cache_file:
+                json.dump(capabilities, cache_file, indent=1, sort_keys=True)
+            replace(temp_path, cache_path)
+        except Exception:
+            remove(temp_path)
+            raise
+    except (IOError, OSError):
+        pass
+
+
+def read_by_chunk(path, chunk_size):
+    with open(path, "rb") as file_object:
+        while True:
+            chunk = file_object.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def octal_escape(chunk):
+    return "".join(chr(byte) if byte in PRINTF_SAFE_BYTES else "\\%03o" % byte for byte in bytearray(chunk))
+
+
+def decode_line(encoder, line):
+    if encoder == "base64":
+        return a2b_base64(line)
+    return unhexlify(line.replace(" ", ""))
+
 
 class AbstractRemoteShell(AbstractShell):
 
+    PUSH_BLOCK_SIZE = 48 * 1024
+    PUSH_WINDOW_SIZE = 8
+    PULL_RANGE_SIZE = 1024 * 1024
+    DELTA_BLOCK_SIZE = 256 * 1024
+    TRANSFER_COMPRESSION = True
+    CAPABILITY_CACHE = CAPABILITY_CACHE_PATH
+
     def __init__(self, target, *args, **kwargs):
         self._target = target
         super(AbstractRemoteShell, self).__init__(*args, **kwargs)
@@ -20,57 +119,231 @@ class AbstractRemoteShell(AbstractShell):
         if not self._connected:
             self.log_oob("connecting to '%s'..." % self._target)
             self.do_connect()
+            try:
+                self.probe_commands()
+            except Exception:
+                # NOTE: a target that cannot even run the probe is left disconnected,
+                #       the next connect() starts over from scratch
+                self.do_disconnect()
+                raise
             self._connected = True
 
+    def probe_commands(self):
+        # NOTE: a single command either confirms the target still matches the cached
+        #       fingerprint (same system, same boot, same PATH) or probes every command
+        key = "%s:%s" % (self.__class__.__name__, self._target)
+        cached = load_capabilities(self.CAPABILITY_CACHE).get(key, {}) if self.CAPABILITY_CACHE else {}
+        fingerprint = cached.get("fingerprint", "")
+        probe = "for c in %s; do command -v $c >/dev/null 2>&1 && echo \"+$c\" || echo \"-$c\"; done" % " ".join(PROBED_COMMANDS)
+        for feature in FEATURE_TESTS:
+            probe += "; %s && echo '+%s' || echo '-%s'" % (availability_test(feature), feature, feature)
+        result = self.execute_command("fp=$(%s); if [ \"$fp\" = '%s' ]; then echo =; else echo \"$fp\"; echo =; %s; fi"
+                                      % (FINGERPRINT_COMMAND, fingerprint.replace("'", "'\\''"), probe))
+        lines = result.stdout()
+        if "=" not in lines:
+            return
+        separator = lines.index("=")
+        if separator == 0:
+            commands = cached.get("commands", {})
+        else:
+            fingerprint = lines[0]
+            commands = dict((line[1:], line[0] == "+") for line in lines[separator + 1:] if line[:1] in ("+", "-"))
+            if self.CAPABILITY_CACHE:
+                save_capabilities(self.CAPABILITY_CACHE, key, fingerprint, commands)
+        with self._commands_lock:
+            self._probed_commands = commands
+            self._available_commands = {}
+
     def disconnect(self):
         if self._connected:
             self.log_oob("disconnecting from '%s'..." % self._target)
             self.do_disconnect()
             self._connected = False
 
+    def close(self):
+        super(AbstractRemoteShell, self).close()
+        self.disconnect()
+
+    def interrupter(self, reader):
+        # NOTE: once its reader is done the command is over, interrupting it after that
+        #       would hit whatever command the shell is running next
+        def interrupt():
+            if reader.is_alive():
+                self.do_interrupt()
+        return interrupt
+
     def do_connect(self):
         raise NotImplementedError("this method should be implemented by subclass")
 
     def do_disconnect(self):
         raise NotImplementedError("this method should be implemented by subclass")
 
+    def do_interrupt(self):
+        raise NotImplementedError("this method should be implemented by subclass")
+
     def do_reboot(self):
         raise NotImplementedError("this method should be implemented by subclass")
 
     def do_pull(self, local_path, remote_path):
-        remote_md5 = self.md5(remote_path)
-        content = unhexlify(self.hexdump(remote_path))
-        if remote_md5 and (md5(content).hexdigest() != remote_md5):
+        encoder = self.get_command("base64", "od", "hexdump")
+        dd = self.get_command("dd", mandatory=False)
+        compressor = self.pull_compressor()
+        remote_stat = self.stat_many([remote_path], md5=True)[remote_path]
+        if remote_stat is None:
             raise RuntimeError("file transfer error")
-        open(local_path, "wb").write(content)
-
-    def do_push(self, local_path, remote_path):
-
-        def read_by_chunk(path, chunk_size=128):
-            file_object = open(path, "rb")
+        local_md5 = md5()
+        with open(local_path, "wb") as local_file:
+            index = 0
             while True:
-                chunk = file_object.read(chunk_size)
-                if not chunk:
+                if dd:
+                    reader = "%s if='%s' bs=%d skip=%d count=1 2>/dev/null" % (dd, remote_path, self.PULL_RANGE_SIZE, index)
+                else:
+                    reader = "cat '%s'" % remote_path
+                if compressor:
+                    reader += " | %s -c" % compressor
+                command = "test -r '%s' && %s | %s" % (remote_path, reader, PULL_ENCODERS[encoder])
+                result = self.execute_command(command, wait=False, retain="none")
+                decompressor = decompressobj(16 + MAX_WBITS) if compressor else None
+                size, received = 0, 0
+                for line in result:
+                    chunk = decode_line(encoder, line)
+                    received += len(chunk)
+                    if decompressor:
+                        chunk = decompressor.decompress(chunk)
+                    local_file.write(chunk)
+                    local_md5.update(chunk)
+                    size += len(chunk)
+                if decompressor:
+                    chunk = decompressor.flush()
+                    local_file.write(chunk)
+                    local_md5.update(chunk)
+                    size += len(chunk)
+                if result.exit_code() != 0:
+                    raise RuntimeError("file transfer error")
+                if compressor and received > COMPRESSION_MAX_RATIO * size:
+                    compressor = None  # NOTE: the data does not compress, the next ranges are sent as is
+                if not dd or size < self.PULL_RANGE_SIZE:
                     break
-                yield chunk
-
-        def backslash_xify(chunk):
-            result = ""
-            while chunk:
-                result += r"\\x" + hexlify(chunk[0:1]).decode('utf-8')
-                chunk = chunk[1:]
-            return result
+                index += 1
+        if remote_stat.md5 and (local_md5.hexdigest() != remote_stat.md5):
+            raise RuntimeError("file transfer error")
+        return remote_stat.mode
 
+    def do_push(self, local_path, remote_path, mode=None):
+        encoder = self.get_command("base64", "uudecode", "printf")
+        compressor = self.push_compressor(local_path)
         local_md5 = md5()
-        self("rm -f %s" % remote_path)
-        for chunk in read_by_chunk(local_path):
+        blocks = []
+        self.execute_command(": > '%s'" % remote_path)
+        for chunk in read_by_chunk(local_path, self.PUSH_BLOCK_SIZE):
             local_md5.update(chunk)
-            self("echo -n -e %s >> %s\n" % (backslash_xify(chunk), remote_path))
-        local_md5 = local_md5.hexdigest()
-        remote_md5 = self.md5(remote_path)
-        if remote_md5 and remote_md5 != local_md5:
+            blocks.append(self.encode_block(encoder, COMPRESSORS[compressor](chunk) if compressor else chunk))
+            if len(blocks) == self.PUSH_WINDOW_SIZE:
+                self.send_blocks(blocks, remote_path, compressor)
+                blocks = []
+        if blocks:
+            self.send_blocks(blocks, remote_path, compressor)
+        self.verify_push(remote_path, local_md5.hexdigest(), mode)
+
+    def verify_push(self, remote_path, local_md5, mode=None, prefix=""):
+        # NOTE: the permissions are applied by the very command that checks the transfer
+        if mode is not None:
+            prefix += "%s %o '%s' && " % (self.get_command("chmod", mandatory=True), mode, remote_path)
+        result = self.execute_command(prefix + self.stat_command([remote_path], md5=True))
+        remote_stat = self.parse_stats([remote_path], result.stdout(), md5=True)[remote_path]
+        if result.exit_code() != 0 or remote_stat is None:
+            raise RuntimeError("file transfer error")
+        if remote_stat.md5 and remote_stat.md5 != local_md5:
             raise RuntimeError("file transfer error")
 
+    def push_compressor(self, local_path):
+        # NOTE: a sample of the file is compressed first, data that is already compressed
+        #       (or too small to be worth it) is sent as is without looking for a compressor
+        if not self.TRANSFER_COMPRESSION:
+            return None
+        with open(local_path, "rb") as local_file:
+            sample = local_file.read(self.PUSH_BLOCK_SIZE)
+        if len(sample) < COMPRESSION_MIN_SIZE or len(compress(sample, 1)) > COMPRESSION_MAX_RATIO * len(sample):
+            return None
+        if not has_lzma():
+            return self.get_command("gzip", mandatory=False)
+        return self.get_command("xz", "gzip", mandatory=False)
+
+    def pull_compressor(self):
+        # NOTE: the target does the compression when pulling, busybox only ships a
+        #       decompressing xz and gzip is much lighter on small CPUs anyway
+        if not self.TRANSFER_COMPRESSION:
+            return None
+        return self.get_command("gzip", mandatory=False)
+
+    def encode_block(self, encoder, chunk):
+        if encoder == "base64":
+            return "base64 -d <<'%s' &&\n%s%s\n" % (HEREDOC_MARKER, encodebytes(chunk).decode("ascii"), HEREDOC_MARKER)
+        elif encoder == "uudecode":
+            lines = [ b2a_uu(chunk[i:i+45], backtick=True).decode("ascii") for i in range(0, len(chunk), 45) ]
+            return "uudecode -o /dev/stdout <<'%s' &&\nbegin 644 -\n%s`\nend\n%s\n" % (HEREDOC_MARKER, "".join(lines), HEREDOC_MARKER)
+        return "".join("printf '%s' &&\n" % octal_escape(chunk[i:i+512]) for i in range(0, len(chunk), 512))
+
+    def send_blocks(self, blocks, remote_path, compressor=None):
+        # NOTE: the blocks are sent back to back as a single command, the remote shell
+        #       decodes them one after the other and we only wait for one exit code
+        decompress = (" | %s -dc" % compressor) if compressor else ""
+        result = self.execute_command("{ %s:\n}%s >> '%s'" % ("".join(blocks), decompress, remote_path))
+        if result.exit_code() != 0:
+            raise RuntimeError("file transfer error")
+
+    def remote_block_md5s(self, remote_path, count):
+        # NOTE: one command hashes the first `count` blocks of the remote file, blocks past
+        #       its end hash as empty ones, returns None when the file cannot be hashed
+        md5sum = self.get_command("md5sum", "md5", mandatory=False)
+        if md5sum is None:
+            return None
+        result = self.execute_command("wc -c < '%s' && i=0 && while [ $i -lt %d ]; do "
+                                      "dd if='%s' bs=%d skip=$i count=1 2>/dev/null | %s; i=$((i+1)); done"
+                                      % (remote_path, count, remote_path, self.DELTA_BLOCK_SIZE, md5sum))
+        lines = result.stdout()
+        if result.exit_code() != 0 or len(lines) != count + 1:
+            return None
+        return int(lines[0]), [ line.split()[0] for line in lines[1:] ]
+
+    def write_blocks(self, remote_path, blocks):
+        # NOTE: blocks are written in place, as many at once as a push window holds
+        encoder = self.get_command("base64", "uudecode", "printf")
+        window = max(1, self.PUSH_BLOCK_SIZE * self.PUSH_WINDOW_SIZE // self.DELTA_BLOCK_SIZE)
+        commands = []
+        for index, chunk in blocks:
+            commands.append("{ %s:\n} | dd of='%s' bs=%d seek=%d conv=notrunc 2>/dev/null &&\n"
+                            % (self.encode_block(encoder, chunk), remote_path, self.DELTA_BLOCK_SIZE, index))
+            if len(commands) == window:
+                self.send_commands(commands)
+                commands = []
+        if commands:
+            self.send_commands(commands)
+
+    def send_commands(self, commands):
+        result = self.execute_command("".join(commands) + ":")
+        if result.exit_code() != 0:
+            raise RuntimeError("file transfer error")
+
+    def do_push_delta(self, local_path, remote_path, mode=None):
+        size = stat(local_path).st_size
+        count = (size + self.DELTA_BLOCK_SIZE - 1) // self.DELTA_BLOCK_SIZE
+        remote = self.remote_block_md5s(remote_path, count)
+        if remote is None:
+            return self.do_push(local_path, remote_path, mode)
+        remote_size, remote_md5s = remote
+        local_md5 = md5()
+        def changed_blocks():
+            for index, chunk in enumerate(read_by_chunk(local_path, self.DELTA_BLOCK_SIZE)):
+                local_md5.update(chunk)
+                if md5(chunk).hexdigest() != remote_md5s[index]:
+                    yield (index, chunk)
+        self.write_blocks(remote_path, changed_blocks())
+        truncate = ""
+        if remote_size > size:
+            truncate = "dd if=/dev/null of='%s' bs=1 seek=%d 2>/dev/null && " % (remote_path, size)
+        self.verify_push(remote_path, local_md5.hexdigest(), mode, truncate)
+
     def reboot_wait_and_reconnect(self, reboot_delay=40):
         self.log_oob("rebooting...")
         self.do_reboot()
@@ -1,28 +1,100 @@
 from .shellerror import ShellError
 from uuid import uuid4
-from logging import getLogger, StreamHandler, Formatter, CRITICAL
-from sys import stdout, stderr
-from termcolor import colored
-from os import chmod, stat
+from .shelllog import log
+from logging import DEBUG, INFO, ERROR, CRITICAL
+from os import chmod, stat, makedirs
+from stat import S_IMODE, S_ISREG, S_ISDIR, S_ISLNK
+from collections import OrderedDict, namedtuple
+from threading import local, RLock
+from weakref import WeakValueDictionary
+from tempfile import NamedTemporaryFile
+import tarfile
+
+CHUNK_SIZE = 64 * 1024
+STAT_MARKER = "CITIZENSHELL_EOF"
+
+# NOTE: some tools come in incompatible flavours (GNU, BSD, busybox...), those are only
+#       considered available when the options we rely on actually work
+FEATURE_TESTS = OrderedDict([
+    ("stat -c", "stat -c %s /"),
+    ("find -printf", "find / -maxdepth 0 -printf ''"),
+])
+
+FileStat = namedtuple("FileStat", ["size", "mode", "mtime", "type", "md5"])
+
+
+def availability_test(command):
+    return "%s >/dev/null 2>&1" % FEATURE_TESTS.get(command, "command -v %s" % command)
+
+
+def file_type(mode):
+    if S_ISLNK(mode):
+        return "symlink"
+    if S_ISDIR(mode):
+        return "directory"
+    if S_ISREG(mode):
+        return "file"
+    return "other"
+
+
+def tar_filter(member, dest_path):
+    # NOTE: the archive comes from the target, its members are vetted like the data filter
+    #       does (nothing outside of the destination, no absolute link, no device) but
+    #       regular files and directories keep the modes they were archived with
+    filtered = tarfile.data_filter(member, dest_path)
+    if member.isreg() or member.isdir():
+        filtered = filtered.replace(mode=member.mode, deep=False)
+    return filtered
+
+
+def parse_mode_string(mode_string):
+    # NOTE: 'rwsr-xr-t' like strings, as printed by ls
+    mode = 0
+    for index, (bit, special) in enumerate(zip((0o4, 0o2, 0o1) * 3, (0, 0, 0o4000, 0, 0, 0o2000, 0, 0, 0o1000))):
+        char = mode_string[index]
+        if char in "rwxst":
+            mode |= bit << (3 * (2 - index // 3))
+        if char in "sStT":
+            mode |= special
+    return mode
+
+
+class ChunkStream(object):
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        size = len(self._buffer) if size < 0 else size
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
 
 class AbstractShell(dict):
 
-    def __init__(self, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+    def __init__(self, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         dict.__init__(self, kwargs)
         self._local_env = {}
         self._check_xc = check_xc
         self._check_err = check_err
         self._wait = wait
+        self._timeout = timeout
         self._id = uuid4().hex[:16].upper()
-        self._in_logger = self._build_logger("%s.in" % str(self), stdout, prefix="$ ", color="cyan")
-        self._out_logger = self._build_logger("%s.out" % str(self), stdout, attrs=[])
-        self._err_logger = self._build_logger("%s.err" % str(self), stderr, color="red")
-        self._oob_logger = self._build_logger("%s.oob" % str(self), stdout, prefix="> ", color="yellow")
-        self._spy_read_logger = self._build_logger("%s.spy.read" % str(self), stdout, prefix="<<< ", color="magenta")
-        self._spy_write_logger = self._build_logger("%s.spy.write" % str(self), stdout, prefix=">>> ", color="green")
         self.set_log_level(log_level)
         self._available_commands = {}
+        self._probed_commands = {}
+        self._commands_lock = RLock()
+        # NOTE: shells can be shared between threads, each one waits on its own last result
+        self._thread_state = local()
+        # NOTE: only weak references, a result dropped by its owner is not kept alive,
+        #       results compare by value and are therefore keyed by their id
+        self._results = WeakValueDictionary()
 
     def id(self):
         return self._id
@@ -30,65 +102,130 @@ class AbstractShell(dict):
     def __repr__(self):
         return "%s(id=%s)" % (self.__class__.__name__, self._id)
 
-    def __call__(self, cmd, check_xc=None, check_err=None, wait=None, cwd=None, **kwargs):
+    def __call__(self, cmd, check_xc=None, check_err=None, wait=None, cwd=None, retain="all",
+                 binary=False, chunk_size=CHUNK_SIZE, timeout=None, **kwargs):
+        check_xc = check_xc if check_xc is not None else self._check_xc
+        check_err = check_err if check_err is not None else self._check_err
+        wait = wait if wait is not None else self._wait
+        timeout = timeout if timeout is not None else self._timeout
+        chunk_size = chunk_size if binary else None
+
+        env = dict(self)
+        env.update(kwargs)
+        result = self.execute_command(cmd, env, wait, check_err, cwd, retain, chunk_size, timeout)
+        self._thread_state.result = result
+
+        if check_xc and result.exit_code() != 0:
+            raise ShellError(cmd, "exit code '%s'" % str(result.exit_code()))
+        return result
+
+    async def run(self, cmd, check_xc=None, check_err=None, wait=None, cwd=None, retain="all",
+                  binary=False, chunk_size=CHUNK_SIZE, timeout=None, **kwargs):
+        check_xc = check_xc if check_xc is not None else self._check_xc
+        check_err = check_err if check_err is not None else self._check_err
+        wait = wait if wait is not None else self._wait
+        timeout = timeout if timeout is not None else self._timeout
+        chunk_size = chunk_size if binary else None
+
+        env = dict(self)
+        env.update(kwargs)
+        result = await self.execute_command_async(cmd, env, wait, check_err, cwd, retain, chunk_size, timeout)
+        if wait:
+            await result.wait()
+
+        if check_xc and await result.exit_code() != 0:
+            raise ShellError(cmd, "exit code '%s'" % str(await result.exit_code()))
+        return result
+
+    def pipeline(self, commands, check_xc=None, check_err=None, wait=None, cwd=None, retain="all", timeout=None, **kwargs):
         check_xc = check_xc if check_xc is not None else self._check_xc
         check_err = check_err if check_err is not None else self._check_err
         wait = wait if wait is not None else self._wait
+        timeout = timeout if timeout is not None else self._timeout
 
         env = dict(self)
         env.update(kwargs)
-        self._result = self.execute_command(cmd, env, wait, check_err, cwd)
+        results = self.execute_pipeline(commands, env, wait, check_err, cwd, retain, timeout)
+        if results:
+            self._thread_state.result = results[-1]
+
+        if check_xc:
+            for cmd, result in zip(commands, results):
+                if result.exit_code() != 0:
+                    # NOTE: the rest of the batch shares the stream of the failed command, it is
+                    #       drained so that nothing is left reading that stream once this raises
+                    for pending in results:
+                        try:
+                            pending.wait()
+                        except Exception:
+                            pass
+                    raise ShellError(cmd, "exit code '%s'" % str(result.exit_code()))
+        return results
 
-        if check_xc and self._result.exit_code() != 0:
-            raise ShellError(cmd, "exit code '%s'" % str(self._result.exit_code()))
-        return self._result
+    def wait(self, timeout=None):
+        self._thread_state.result.wait(timeout)
 
-    def wait(self):
-        self._result.wait()
+    def track_result(self, result):
+        self._results[id(result)] = result
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
+    def close(self):
+        for result in list(self._results.values()):
+            result.cancel()
+        self._results.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
         raise NotImplementedError("this method must be implemented by the subclass")
 
-    @staticmethod
-    def _build_logger(name, stream, prefix="", color=None, attrs=["bold"]):
-        logger = getLogger(name)
-        logger.setLevel(CRITICAL)
-        handler = StreamHandler(stream)
-        formatter = Formatter(colored(prefix, attrs=attrs) + colored('%(message)s', color=color, attrs=attrs))
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return logger
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        # NOTE: backends that cannot submit several commands at once run them one after the other
+        return [ self.execute_command(command, env, True, check_err, cwd, retain, timeout=timeout) for command in commands ]
+
+    async def execute_command_async(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        # NOTE: the backends doing blocking I/O are dispatched from the default executor,
+        #       their output is then streamed to the event loop by their reader threads
+        from asyncio import get_event_loop
+        from .asyncshellresult import AsyncShellResult
+        result = await get_event_loop().run_in_executor(None, self.execute_command, command, env, False, check_err,
+                                                         cwd, "none", chunk_size)
+        return AsyncShellResult(self, command, result._queue, wait, check_err, retain, result._canceller, timeout,
+                                log_stdin=False)
 
     def set_log_level(self, level):
         self._log_level = level
-        self._in_logger.setLevel(level)
-        self._out_logger.setLevel(level)
-        self._err_logger.setLevel(level)
-        self._oob_logger.setLevel(level)
-        self._spy_read_logger.setLevel(level)
-        self._spy_write_logger.setLevel(level)
+
+    # NOTE: the shared loggers are only reached when the shell's own level lets the
+    #       record through, a disabled shell does not even build the record
 
     def log_stdin(self, text):
-        self._in_logger.info(text)
+        if self._log_level <= INFO: log("in", self._id, text)
 
     def log_stdout(self, text):
-        self._out_logger.info(text)
+        if self._log_level <= INFO: log("out", self._id, text)
 
     def log_stderr(self, text):
-        self._err_logger.error(text)
+        if self._log_level <= ERROR: log("err", self._id, text)
 
     def log_oob(self, text):
-        self._oob_logger.info(text)
+        if self._log_level <= INFO: log("oob", self._id, text)
 
     def log_spy_read(self, text):
-        self._spy_read_logger.debug(repr(text))
+        if self._log_level <= DEBUG: log("spy.read", self._id, repr(text))
 
     def log_spy_write(self, text):
-        self._spy_write_logger.debug(repr(text))
+        if self._log_level <= DEBUG: log("spy.write", self._id, repr(text))
 
     def detect_command(self, *alternatives, **kwargs):
         for alternative in alternatives:
-            if self.execute_command("command -v %s" % alternative):
+            available = self._probed_commands.get(alternative)
+            if available is None:
+                available = bool(self.execute_command(availability_test(alternative)))
+            if available:
                 return alternative
         if kwargs.get("mandatory", True):
             raise RuntimeError("could find command '%s', tried any of the the following: %s" % (alternatives[0], alternatives))
@@ -96,11 +233,12 @@ class AbstractShell(dict):
         
     def get_command(self, *alternatives, **kwargs):
         command = alternatives[0]
-        if command not in self._available_commands:
-            detected = self.detect_command(*alternatives, **kwargs)
-            self._available_commands[command] = detected
-            return detected
-        return self._available_commands[command]
+        with self._commands_lock:
+            if command not in self._available_commands:
+                detected = self.detect_command(*alternatives, **kwargs)
+                self._available_commands[command] = detected
+                return detected
+            return self._available_commands[command]
 
     def md5(self, path, mandatory=False):
         command = self.get_command("md5sum", "md5", mandatory=mandatory)
@@ -115,32 +253,57 @@ class AbstractShell(dict):
             result = self.execute_command("od -t x1 -An %s" % path)
         return str(result).replace(" ", "").rstrip("\r\n")
         
+    def stat_command(self, paths, md5=False):
+        # NOTE: paths are fed through a heredoc, one per line, and every path prints
+        #       exactly one metadata line ('?' when missing) then its md5 if asked to
+        tool = self.get_command("stat -c", "find -printf", "ls")
+        if tool == "stat -c":
+            metadata = "stat -c '%s %f %Y' \"$p\""
+        elif tool == "find -printf":
+            metadata = "find \"$p\" -maxdepth 0 -printf '%s %m %T@ %y\\n'"
+        else:
+            metadata = "ls -ldn \"$p\""
+        command = "%s 2>/dev/null < /dev/null || echo '?'" % metadata
+        if md5:
+            md5sum = self.get_command("md5sum", "md5", mandatory=False)
+            md5sum = { "md5sum": "md5sum", "md5": "md5 -q" }.get(md5sum, "false")
+            command += "; if [ -f \"$p\" ] && [ ! -h \"$p\" ]; then %s \"$p\" 2>/dev/null < /dev/null || echo -; else echo -; fi" % md5sum
+        return "{ while IFS= read -r p; do %s; done <<'%s'\n%s\n%s\n}" % (command, STAT_MARKER, "\n".join(paths), STAT_MARKER)
+
+    def parse_stats(self, paths, lines, md5=False):
+        tool = self.get_command("stat -c", "find -printf", "ls")
+        lines = iter(lines)
+        stats = OrderedDict()
+        for path in paths:
+            fields = next(lines, "?").split()
+            digest = next(lines, "-").split()[0].lstrip("\\") if md5 else "-"
+            digest = None if digest == "-" else digest
+            if fields[:1] == ["?"]:
+                stats[path] = None
+            elif tool == "stat -c":
+                mode = int(fields[1], 16)
+                stats[path] = FileStat(int(fields[0]), S_IMODE(mode), int(fields[2]), file_type(mode), digest)
+            elif tool == "find -printf":
+                kind = { "f": "file", "d": "directory", "l": "symlink" }.get(fields[3], "other")
+                stats[path] = FileStat(int(fields[0]), int(fields[1], 8), int(float(fields[2])), kind, digest)
+            else:
+                kind = { "-": "file", "d": "directory", "l": "symlink" }.get(fields[0][0], "other")
+                stats[path] = FileStat(int(fields[4]), parse_mode_string(fields[0][1:10]), None, kind, digest)
+        return stats
+
+    def stat_many(self, paths, md5=False):
+        paths = list(paths)
+        if not paths:
+            return OrderedDict()
+        result = self.execute_command(self.stat_command(paths, md5))
+        return self.parse_stats(paths, result.stdout(), md5)
+
     def get_permissions(self, path):
-        permissions = self.execute_command("ls -la %s" % path).stdout()[0].split()[0]
-        assert len(permissions) == 10
-        result = 0
-        if (permissions[1] == "r"): 
-            result = result | 0o400
-        if (permissions[2] == "w"):
-            result = result | 0o200
-        if (permissions[3] == "x"):
-            result = result | 0o100
-
-        if (permissions[4] == "r"): 
-            result = result | 0o040
-        if (permissions[5] == "w"):
-            result = result | 0o020
-        if (permissions[6] == "x"):
-            result = result | 0o010
-
-        if (permissions[7] == "r"): 
-            result = result | 0o004
-        if (permissions[8] == "w"):
-            result = result | 0o002
-        if (permissions[9] == "x"):
-            result = result | 0o001
-        return result
-    
+        stats = self.stat_many([path])[path]
+        if stats is None:
+            raise RuntimeError("could not get permissions of '%s'" % path)
+        return stats.mode
+
     def set_permissions(self, path, permissions):
         chmod = self.get_command("chmod", mandatory=True)
         self("%s %o '%s'" % (chmod, permissions, path))
@@ -148,17 +311,95 @@ class AbstractShell(dict):
     def do_pull(self, local_path, remote_path):
         raise NotImplementedError("this method must be implemented by the subclass")
 
-    def do_push(self, local_path, remote_path):
+    def do_push(self, local_path, remote_path, mode=None):
         raise NotImplementedError("this method must be implemented by the subclass")
 
+    def do_push_delta(self, local_path, remote_path, mode=None):
+        # NOTE: shells without a cheaper way to update a file in place simply copy it all
+        self.do_push(local_path, remote_path, mode)
+
     def pull(self, local_path, remote_path):
+        # NOTE: do_pull returns the remote permissions when it learned them along the way
         self.log_oob("'%s' <- '%s'" % (local_path, remote_path))
-        self.do_pull(local_path, remote_path)
-        chmod(local_path, self.get_permissions(remote_path))
+        mode = self.do_pull(local_path, remote_path)
+        chmod(local_path, mode if mode is not None else self.get_permissions(remote_path))
+
+    def push(self, local_path, remote_path, delta=False):
+        # NOTE: do_push applies the permissions itself, with no extra round trip when possible
+        self.log_oob("'%s' -> '%s'%s" % (local_path, remote_path, " (delta)" if delta else ""))
+        mode = stat(local_path).st_mode & 0o777
+        if delta:
+            self.do_push_delta(local_path, remote_path, mode)
+        else:
+            self.do_push(local_path, remote_path, mode)
+
+    def pull_many(self, transfers):
+        for local_path, remote_path in transfers:
+            self.pull(local_path, remote_path)
+
+    def tree_compression(self, compress):
+        # NOTE: unless told otherwise, the archive is compressed whenever the target has gzip
+        if compress is None:
+            return bool(self.get_command("gzip", mandatory=False))
+        return compress
+
+    @staticmethod
+    def untar_command(remote_path, compress, archive="-"):
+        # NOTE: missing parents are created under the caller's umask, only the archived
+        #       entries get their modes restored by tar, even when not run as root
+        unpack = ("gzip -dc %s | tar -xpf -" % archive) if compress else ("tar -xpf %s" % archive)
+        return "mkdir -p '%s' && %s -C '%s'" % (remote_path, unpack, remote_path)
+
+    def pull_tree(self, local_path, remote_path, compress=None):
+        self.log_oob("'%s' <= '%s'" % (local_path, remote_path))
+        if not hasattr(tarfile, "data_filter"):
+            raise RuntimeError("could not pull '%s': this python cannot extract archives safely" % remote_path)
+        compress = self.tree_compression(compress)
+        command = "cd '%s' && tar -cf - ." % remote_path + (" | gzip -c" if compress else "")
+        result = self.execute_command(command, wait=False, retain="none", chunk_size=CHUNK_SIZE)
+        stderr, errors = [], []
+        def read_chunks():
+            for fd, data in result.iter_combined():
+                if fd == 1:
+                    yield data
+                else:
+                    stderr.append(data)
+        chunks = read_chunks()
+        makedirs(local_path, exist_ok=True)
+        try:
+            with tarfile.open(fileobj=ChunkStream(chunks), mode="r|gz" if compress else "r|") as archive:
+                archive.extractall(local_path, filter=tar_filter)
+        except tarfile.TarError as e:
+            errors.append(str(e))
+        for _ in chunks:
+            pass
+        # NOTE: tar warns on stderr about things it got over, only its exit code tells a failure
+        if result.exit_code() != 0 or errors:
+            raise RuntimeError("could not pull '%s': %s" % (remote_path, " ".join(stderr + errors)))
+
+    def push_tree(self, local_path, remote_path, compress=None):
+        self.log_oob("'%s' => '%s'" % (local_path, remote_path))
+        self.do_push_tree(local_path, remote_path, self.tree_compression(compress))
+
+    def do_push_tree(self, local_path, remote_path, compress):
+        # NOTE: the archive goes through the regular push engine next to the
+        #       destination, so that removing it leaves the tree timestamps alone
+        remote_archive = "%s.%s.tar" % (remote_path.rstrip("/"), uuid4().hex)
+        result = self.execute_command("mkdir -p '%s'" % remote_path)
+        if result.exit_code() != 0:
+            raise RuntimeError("could not push '%s': %s" % (local_path, " ".join(result.stderr())))
+        with NamedTemporaryFile(suffix=".tar") as local_archive:
+            with tarfile.open(fileobj=local_archive, mode="w|gz" if compress else "w|") as archive:
+                archive.add(local_path, arcname=".")
+            local_archive.flush()
+            self.do_push(local_archive.name, remote_archive)
+        command = self.untar_command(remote_path, compress, "'%s'" % remote_archive)
+        result = self.execute_command("%s; xc=$?; rm -f '%s'; exit $xc" % (command, remote_archive))
+        if result.exit_code() != 0:
+            raise RuntimeError("could not push '%s': %s" % (local_path, " ".join(result.stderr())))
 
-    def push(self, local_path, remote_path):
-        self.log_oob("'%s' -> '%s'" % (local_path, remote_path))
-        self.do_push(local_path, remote_path)
-        self.set_permissions(remote_path, (stat(local_path).st_mode & 0o777))
+    def push_many(self, transfers):
+        for local_path, remote_path in transfers:
+            self.push(local_path, remote_path)
 
 
@@ -0,0 +1,227 @@
+from socket import create_connection, SHUT_RDWR, IPPROTO_TCP, TCP_NODELAY
+from struct import pack, unpack
+from stat import S_IFREG
+from time import time, sleep
+
+ADB_SERVER = "localhost:5037"
+SYNC_DATA_SIZE = 64 * 1024
+MAX_REQUEST_SIZE = 0xffff
+
+
+def parse_server(server):
+    host, _, port = server.rpartition(":")
+    return (host or "localhost", int(port))
+
+
+class AdbStream(object):
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._reader = sock.makefile("rb")
+        self.eof = False
+
+    def readline(self):
+        line = self._reader.readline()
+        if not line:
+            self.eof = True
+            return None
+        return line
+
+    def write(self, data):
+        self._socket.sendall(data)
+
+    def close(self):
+        # NOTE: the device hangs up the service (and kills the command) when the socket goes away
+        self.eof = True
+        try:
+            self._socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.close()
+        self._socket.close()
+
+
+class AdbClient(object):
+
+    def __init__(self, server=ADB_SERVER):
+        self._server = server
+        self._address = parse_server(server)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, repr(self._server))
+
+    def _connect(self):
+        # NOTE: commands and their output are made of small writes, which must
+        #       not wait for the acknowledgement of the previous one
+        sock = create_connection(self._address)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _recv_exactly(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise RuntimeError("adb server closed the connection")
+            data += chunk
+        return data
+
+    def _recv_string(self, sock):
+        return self._recv_exactly(sock, int(self._recv_exactly(sock, 4), 16)).decode("utf-8", "replace")
+
+    def _request(self, sock, service):
+        # NOTE: each request is prefixed by its length in 4 hex digits and answered by OKAY or FAIL
+        service = service.encode("utf-8")
+        sock.sendall(b"%04x" % len(service) + service)
+        status = self._recv_exactly(sock, 4)
+        if status == b"FAIL":
+            raise RuntimeError("adb: %s" % self._recv_string(sock))
+        if status != b"OKAY":
+            raise RuntimeError("adb: unexpected status %s" % repr(status))
+
+    def _host_query(self, service):
+        sock = self._connect()
+        try:
+            self._request(sock, service)
+            return self._recv_string(sock)
+        finally:
+            sock.close()
+
+    def _transport(self, serial, service):
+        sock = self._connect()
+        try:
+            self._request(sock, "host:transport:%s" % serial)
+            self._request(sock, service)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _read_all(self, sock):
+        data = b""
+        while True:
+            chunk = sock.recv(SYNC_DATA_SIZE)
+            if not chunk:
+                return data.decode("utf-8", "replace")
+            data += chunk
+
+    def devices(self):
+        return self._host_query("host:devices")
+
+    def get_state(self, serial):
+        return self._host_query("host-serial:%s:get-state" % serial)
+
+    def connect(self, target):
+        message = self._host_query("host:connect:%s" % target)
+        if not message.startswith(("connected", "already connected")):
+            raise RuntimeError("adb: %s" % message)
+
+    def disconnect(self, target):
+        self._host_query("host:disconnect:%s" % target)
+
+    def wait_for_device(self, serial, timeout=None, delay=1):
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            try:
+                if self.get_state(serial) == "device":
+                    return
+            except (RuntimeError, OSError):
+                pass
+            if deadline is not None and time() > deadline:
+                raise RuntimeError("device '%s' did not come back after %s seconds" % (serial, timeout))
+            sleep(delay)
+
+    def shell(self, serial, command):
+        service = "shell:%s" % command
+        if len(service.encode("utf-8")) <= MAX_REQUEST_SIZE:
+            return AdbStream(self._transport(serial, service))
+        # NOTE: the length of a request is given in 4 hex digits, longer commands (push
+        #       windows for instance) are typed into a shell that exits right after them
+        stream = AdbStream(self._transport(serial, "shell:sh"))
+        stream.write(("%s < /dev/null\nexit\n" % command).encode("utf-8"))
+        return stream
+
+    def root(self, serial):
+        sock = self._transport(serial, "root:")
+        try:
+            return self._read_all(sock)
+        finally:
+            sock.close()
+
+    def reboot(self, serial):
+        sock = self._transport(serial, "reboot:")
+        try:
+            self._read_all(sock)
+        finally:
+            sock.close()
+
+    # NOTE: the sync service speaks its own protocol, each message is a 4 bytes id
+    #       followed by a little endian 32 bits length (or value) and its payload
+
+    @staticmethod
+    def _sync_send(sock, message_id, payload=b""):
+        sock.sendall(message_id + pack("<I", len(payload)) + payload)
+
+    def _sync_recv(self, sock):
+        header = self._recv_exactly(sock, 8)
+        return header[:4], unpack("<I", header[4:])[0]
+
+    def _sync_fail(self, sock, length):
+        return RuntimeError("adb: %s" % self._recv_exactly(sock, length).decode("utf-8", "replace"))
+
+    def _sync_stat(self, sock, remote_path):
+        self._sync_send(sock, b"STAT", remote_path.encode("utf-8"))
+        message_id, mode = self._sync_recv(sock)
+        size, mtime = unpack("<II", self._recv_exactly(sock, 8))
+        if message_id != b"STAT":
+            raise RuntimeError("adb: unexpected sync message %s" % repr(message_id))
+        return mode, size, mtime
+
+    def stat(self, serial, remote_path):
+        sock = self._transport(serial, "sync:")
+        try:
+            attributes = self._sync_stat(sock, remote_path)
+            self._sync_send(sock, b"QUIT")
+            return attributes
+        finally:
+            sock.close()
+
+    def push(self, serial, local_path, remote_path, mode=0o644):
+        sock = self._transport(serial, "sync:")
+        try:
+            self._sync_send(sock, b"SEND", ("%s,%d" % (remote_path, S_IFREG | mode)).encode("utf-8"))
+            with open(local_path, "rb") as local_file:
+                while True:
+                    data = local_file.read(SYNC_DATA_SIZE)
+                    if not data:
+                        break
+                    self._sync_send(sock, b"DATA", data)
+            sock.sendall(b"DONE" + pack("<I", int(time())))
+            message_id, length = self._sync_recv(sock)
+            if message_id == b"FAIL":
+                raise self._sync_fail(sock, length)
+            self._sync_send(sock, b"QUIT")
+        finally:
+            sock.close()
+
+    def pull(self, serial, remote_path, local_path):
+        # NOTE: returns the permissions of the remote file
+        sock = self._transport(serial, "sync:")
+        try:
+            mode, _, _ = self._sync_stat(sock, remote_path)
+            if mode == 0:
+                raise RuntimeError("adb: remote object '%s' does not exist" % remote_path)
+            self._sync_send(sock, b"RECV", remote_path.encode("utf-8"))
+            with open(local_path, "wb") as local_file:
+                while True:
+                    message_id, length = self._sync_recv(sock)
+                    if message_id == b"DONE":
+                        break
+                    if message_id == b"FAIL":
+                        raise self._sync_fail(sock, length)
+                    local_file.write(self._recv_exactly(sock, length))
+            self._sync_send(sock, b"QUIT")
+            return mode & 0o7777
+        finally:
+            sock.close()
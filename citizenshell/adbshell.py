@@ -1,39 +1,77 @@
 from .abstractremoteshell import AbstractRemoteShell
-from .streamreader import PrefixedStreamReader
+from .streamreader import PrefixedStreamReader, PipelinedStreamReader
 from .shellresult import ShellResult
-from .localshell import LocalShell
+from .localshell import LocalShell, kill_process_group
+from .adbclient import AdbClient, ADB_SERVER
 from .queue import Queue
-from subprocess import Popen, PIPE, check_output, call
-from threading import Thread
+from subprocess import Popen, PIPE, STDOUT, check_output, call
+from threading import Thread, Lock
+from uuid import uuid4
 from time import sleep
 from logging import CRITICAL
 from re import compile as re
 
+
+class AdbProcessStream(object):
+
+    def __init__(self, process):
+        self._process = process
+
+    @property
+    def eof(self):
+        return self._process.poll() is not None
+
+    def readline(self):
+        line = self._process.stdout.readline()
+        if not line:
+            # NOTE: reaps the adb client and closes its pipes
+            self._process.communicate()
+            return None
+        return line
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def close(self):
+        if self._process.stdin:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+        kill_process_group(self._process)
+        self._process.wait()
+
+
 class AdbShell(AbstractRemoteShell):
 
     ADB_LOCAL_DEVICE_RE = re(r"^(?P<device>[0-9a-z]+)\s+device$")
     ADB_REMOTE_DEVICE_RE = re(r"^(?P<hostname>[^:]+)\:(?P<port>\d+).*device$")
 
     @classmethod
-    def list_available_devices(cls):
+    def list_available_devices(cls, server=None):
         local_devices = []
         remote_devices = []
-        if call("command -v adb", shell=True) == 0:
-            for line in check_output("adb devices", shell=True).splitlines():
-                line = line.decode("utf-8")
-                match = cls.ADB_LOCAL_DEVICE_RE.match(line)
-                if match:
-                    local_devices.append(match.group("device"))
-                    continue
-                match = cls.ADB_REMOTE_DEVICE_RE.match(line)
-                if match:
-                    remote_devices.append("%s:%s" % (match.group("hostname"), match.group("port")))
+        if server:
+            lines = AdbClient(ADB_SERVER if server is True else server).devices().splitlines()
+        elif call("command -v adb", shell=True) == 0:
+            lines = check_output("adb devices", shell=True).decode("utf-8").splitlines()
+        else:
+            lines = []
+        for line in lines:
+            match = cls.ADB_LOCAL_DEVICE_RE.match(line)
+            if match:
+                local_devices.append(match.group("device"))
+                continue
+            match = cls.ADB_REMOTE_DEVICE_RE.match(line)
+            if match:
+                remote_devices.append("%s:%s" % (match.group("hostname"), match.group("port")))
         return (local_devices, remote_devices)
 
-    def __init__(self, hostname=None, device=None, port=5555, root=False,
-                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+    def __init__(self, hostname=None, device=None, port=5555, root=False, persistent=False, server=None,
+                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         if hostname is None and device is None:
-            local, remote = self.list_available_devices()
+            local, remote = self.list_available_devices(server)
             if len(local) == 1 and len(remote) == 0:
                 self._target = local[0]
                 self._remote = False
@@ -48,12 +86,27 @@ class AdbShell(AbstractRemoteShell):
             self._target = device
             self._remote = False
         self._root = root
+        self._persistent = persistent
+        # NOTE: with server=True (or "host:port") the adb server is spoken to directly
+        #       over its socket, instead of spawning the adb binary for every operation
+        self._client = AdbClient(ADB_SERVER if server is True else server) if server else None
+        self._shell_stream = None
+        self._persistent_lock = Lock()
+        self._persistent_reader = None
         super(AdbShell, self).__init__(self._target, check_xc=check_xc, check_err=check_err,
-                                       wait=wait, log_level=log_level, **kwargs)
+                                       wait=wait, log_level=log_level, timeout=timeout, **kwargs)
         self._localshell = LocalShell(log_level=log_level, check_err=True, check_xc=True)
         self.connect()
 
     def do_connect(self):
+        if self._client:
+            self._connect_server()
+        else:
+            self._connect_binary()
+        if self._persistent:
+            self._shell_stream = self._open_shell_stream()
+
+    def _connect_binary(self):
         self._localshell("adb start-server", check_err=False)
         if self._remote:
             self._localshell("adb connect %s" % (self._target))
@@ -65,33 +118,126 @@ class AdbShell(AbstractRemoteShell):
             if self._root:
                 self._localshell("adb -s %s root" % (self._target))
 
-    def do_disconnect(self):
+    def _connect_server(self):
+        try:
+            self._client.devices()
+        except OSError:
+            # NOTE: only the adb binary can start the server itself
+            self._localshell("adb start-server", check_err=False)
         if self._remote:
+            self._client.connect(self._target)
+        if self._root:
+            self.log_oob(self._client.root(self._target).strip())
+            if self._remote:
+                self._client.disconnect(self._target)
+                self._client.connect(self._target)
+            self._client.wait_for_device(self._target, timeout=10)
+
+    def do_disconnect(self):
+        if self._shell_stream is not None:
+            self._shell_stream.close()
+            self._shell_stream = None
+        if self._remote and self._client:
+            self._client.disconnect(self._target)
+        elif self._remote:
             self._localshell("adb disconnect %s" % (self._target), check_err=False)
 
+    def _open_shell_stream(self):
+        # NOTE: there is no tty on our end, so the device shell runs without a pty, commands
+        #       are read from its stdin one after the other and nothing is echoed back
+        if self._client:
+            return self._client.shell(self._target, "sh")
+        return AdbProcessStream(Popen(["adb", "-s", self._target, "shell"], stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                                      start_new_session=True))
+
+    def close(self):
+        super(AdbShell, self).close()
+        self._localshell.close()
+
     def readline(self):
-        line = self._process.stdout.readline()
-        return line if line else None
+        line = self._shell_stream.readline()
+        if line is None or line.rstrip(b"\r\n") == self._sentinel:
+            return None
+        return line
+
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        if self._persistent:
+            return self.execute_persistent_command(command, env, wait, check_err, cwd, retain, chunk_size, timeout)
+        formatted_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
+        if self._client:
+            stream = self._client.shell(self._target, formatted_command)
+        else:
+            adb_command = "adb -s %s shell '%s'" % (self._target, formatted_command.replace('\'', '\'"\'"\''))
+            stream = AdbProcessStream(Popen(adb_command, env=None, shell=True, stdout=PIPE, stderr=PIPE,
+                                            start_new_session=True))
+        queue = Queue()
+        PrefixedStreamReader(stream, queue, chunk_size)
+        # NOTE: the remote command is hung up when its adb client or socket goes away
+        return ShellResult(self, command, queue, wait, check_err, retain, stream.close, timeout=timeout)
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
-        formatted_command = PrefixedStreamReader.wrap_command(command, env, cwd)
-        adb_command = "adb -s %s shell '%s'" % (self._target, formatted_command.replace('\'', '\'"\'"\''))
-        self._process = Popen(adb_command, env=None, shell=True, stdout=PIPE, stderr=PIPE)
+    def execute_persistent_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        wrapped_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
         queue = Queue()
-        PrefixedStreamReader(self, queue)
-        return ShellResult(self, command, queue, wait, check_err)
+        with self._persistent_lock:
+            self._write_persistent(wrapped_command)
+            self._persistent_reader = reader = PrefixedStreamReader(self, queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
 
-    def do_push(self, local_path, remote_path):
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        if not self._persistent:
+            return super(AdbShell, self).execute_pipeline(commands, env, wait, check_err, cwd, retain, timeout)
+        tags, wrapped_commands = PipelinedStreamReader.wrap_commands(commands, env, cwd)
+        queues = [ Queue() for _ in commands ]
+        with self._persistent_lock:
+            self._write_persistent(wrapped_commands)
+            self._persistent_reader = reader = PipelinedStreamReader(self, zip(tags, queues))
+        return [ ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+                 for command, queue in zip(commands, queues) ]
+
+    def _write_persistent(self, wrapped_command):
+        # NOTE: the device shell carries one command at a time, concurrent callers
+        #       wait for the output of the previous command to be read entirely
+        if self._persistent_reader is not None:
+            self._persistent_reader.join()
+        # NOTE: a syntax error or a cancelled command ends the device shell, in which
+        #       case we transparently open a new one for the next command
+        if self._shell_stream is None or self._shell_stream.eof:
+            if self._shell_stream is not None:
+                self._shell_stream.close()
+            self._shell_stream = self._open_shell_stream()
+        self._sentinel = ("EOC-" + uuid4().hex.upper()).encode("utf-8")
+        self._shell_stream.write(("%s < /dev/null\necho %s\n" % (wrapped_command, self._sentinel.decode("utf-8"))).encode("utf-8"))
+
+    def do_interrupt(self):
+        # NOTE: without a pty there is no Ctrl-C, the adb client (or socket) is closed
+        #       instead and the next command transparently opens a new shell
+        self._shell_stream.close()
+
+    def do_push(self, local_path, remote_path, mode=None):
+        if self._client:
+            # NOTE: the sync service creates the file with its permissions right away
+            return self._client.push(self._target, local_path, remote_path, mode if mode is not None else 0o644)
         self._localshell("adb -s %s push '%s' '%s'" % (self._target, local_path, remote_path), check_err=False)
+        if mode is not None:
+            self.set_permissions(remote_path, mode)
 
     def do_pull(self, local_path, remote_path):
+        if self._client:
+            return self._client.pull(self._target, remote_path, local_path)
         self._localshell("adb -s %s pull '%s' '%s'" % (self._target, remote_path, local_path), check_err=False)
 
     def reboot_wait_and_reconnect(self, reboot_delay=40):
         self.log_oob("rebooting...")
-        Thread(target=lambda:[sleep(3), self.disconnect()]).start()
-        self._localshell("adb -s %s reboot" % self._target)
-        if self._remote == False:
+        if self._client:
+            self._client.reboot(self._target)
+            self.disconnect()
+        else:
+            Thread(target=lambda:[sleep(3), self.disconnect()]).start()
+            self._localshell("adb -s %s reboot" % self._target)
+        if self._remote == False and self._client:
+            sleep(3)
+            self._client.wait_for_device(self._target)
+        elif self._remote == False:
             self._localshell("adb -s %s wait-for-device" % (self._target))
         else:
             sleep_left=reboot_delay
@@ -101,6 +247,3 @@ class AdbShell(AbstractRemoteShell):
                 sleep(sleep_delta)
                 sleep_left -= sleep_delta
         self.connect()
-
-
-
@@ -0,0 +1,89 @@
+from asyncio import Event, get_event_loop, wait_for, TimeoutError
+from .shellresult import AbstractShellResult, make_deadline, earliest_deadline
+from .queue import Empty
+from time import time
+
+
+class AsyncShellResult(AbstractShellResult):
+
+    def __init__(self, shell, command, queue, wait, check_err, retain="all", canceller=None, timeout=None, log_stdin=True):
+        super(AsyncShellResult, self).__init__(shell, command, queue, wait, check_err, retain, canceller, timeout, log_stdin)
+        self._loop = get_event_loop()
+        self._event = Event()
+        # NOTE: the queue is fed by reader threads, each put wakes up the event loop
+        queue.on_put = self._notify
+
+    def _notify(self):
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass  # the loop was closed while the command was still running
+
+    async def _get(self, deadline):
+        if self._timed_out:
+            raise self._timed_out
+        while True:
+            try:
+                return self._queue.get_nowait()
+            except Empty:
+                self._event.clear()
+            try:
+                return self._queue.get_nowait()
+            except Empty:
+                pass
+            if deadline is None:
+                await self._event.wait()
+                continue
+            try:
+                await wait_for(self._event.wait(), max(0, deadline[0] - time()))
+            except TimeoutError:
+                self._expire(deadline)
+
+    async def iter_combined(self, timeout=None):
+        if self._finished:
+            for entry in self._combined or []:
+                yield entry
+        else:
+            deadline = earliest_deadline(self._deadline, make_deadline(timeout))
+            while self._open_streams:
+                fd, line = await self._get(deadline)
+                if self._feed(fd, line):
+                    yield (fd, line)
+                    self._check(fd, line)
+            self._finish()
+
+    async def iter_stdout(self, timeout=None):
+        async for fd, line in self.iter_combined(timeout):
+            if fd == 1:
+                yield line
+
+    def iter_chunks(self, timeout=None):
+        return self.iter_stdout(timeout)
+
+    async def iter_stderr(self, timeout=None):
+        async for fd, line in self.iter_combined(timeout):
+            if fd == 2:
+                yield line
+
+    async def wait(self, timeout=None):
+        async for _ in self.iter_combined(timeout):
+            pass
+
+    async def stdout(self):
+        return [ line async for line in self.iter_stdout() ]
+
+    async def stderr(self):
+        return [ line async for line in self.iter_stderr() ]
+
+    async def combined(self):
+        return [ entry async for entry in self.iter_combined() ]
+
+    async def exit_code(self, timeout=None):
+        await self.wait(timeout)
+        return self._xc
+
+    def __aiter__(self):
+        return self.iter_stdout()
+
+    def __repr__(self):
+        return "%s(%s, '%s')" % (self.__class__.__name__, str(self._shell), self.command())
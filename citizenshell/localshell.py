@@ -1,35 +1,89 @@
 from subprocess import Popen, PIPE
 
-from .abstractshell import AbstractShell
+from .abstractshell import AbstractShell, FileStat, file_type
 from .shellresult import ShellResult
-from .streamreader import StandardStreamReader
+from .streamselector import StreamSelector, LineBuffer, make_stdout_buffer, READ_SIZE
 from .queue import Queue
-from threading import Thread
 from shutil import copyfile
-from os import environ
+from os import environ, chmod, lstat, killpg
+from stat import S_IMODE, S_ISREG
+from collections import OrderedDict
+from hashlib import md5 as md5_hash
 from logging import CRITICAL
+from signal import SIGKILL
+
+
+def kill_process_group(process):
+    # NOTE: commands run in a session of their own, so that the processes forked by
+    #       the shell are killed along with it and none of them keeps the pipes open
+    if process.returncode is None:
+        try:
+            killpg(process.pid, SIGKILL)
+        except OSError:
+            pass
 
 class LocalShell(AbstractShell):
 
-    def __init__(self, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+    def __init__(self, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         AbstractShell.__init__(self, check_xc=check_xc, check_err=check_err,
-                               wait=wait, log_level=log_level, **kwargs)
+                               wait=wait, log_level=log_level, timeout=timeout, **kwargs)
         self.update(environ)
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
-        process = Popen(command, env=env, shell=True, stdout=PIPE, stderr=PIPE, cwd=cwd)
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        process = Popen(command, env=env, shell=True, stdout=PIPE, stderr=PIPE, cwd=cwd, start_new_session=True)
         queue = Queue()
-        StandardStreamReader(process.stdout, 1, queue)
-        StandardStreamReader(process.stderr, 2, queue)
-        def post_process_exit_code():
-            queue.put( (0, process.wait()) )
-            queue.put( (0, None) )
-        Thread(target=post_process_exit_code).start()
-        return ShellResult(self, command, queue, wait, check_err)
+        StreamSelector.instance().watch_process(process, queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, lambda: kill_process_group(process), timeout=timeout)
+
+    async def execute_command_async(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        from asyncio import create_subprocess_shell, ensure_future, gather
+        from asyncio.subprocess import PIPE as ASYNC_PIPE
+        from .asyncshellresult import AsyncShellResult
+        process = await create_subprocess_shell(command, env=env, cwd=cwd, stdout=ASYNC_PIPE, stderr=ASYNC_PIPE,
+                                                start_new_session=True)
+        queue = Queue()
+        async def read_stream(stream, line_buffer, read_size=READ_SIZE):
+            while True:
+                data = await stream.read(read_size)
+                if not data: break
+                line_buffer.feed(data)
+            line_buffer.close()
+        async def post_process_exit_code():
+            try:
+                await gather(read_stream(process.stdout, make_stdout_buffer(queue, chunk_size), chunk_size or READ_SIZE),
+                             read_stream(process.stderr, LineBuffer(2, queue)))
+                queue.put( (0, await process.wait()) )
+                queue.put( (0, None) )
+            except Exception as e:
+                queue.put( (0, e) )
+        result = AsyncShellResult(self, command, queue, wait, check_err, retain, lambda: kill_process_group(process), timeout=timeout)
+        result._producer = ensure_future(post_process_exit_code())
+        return result
+
+    def stat_many(self, paths, md5=False):
+        stats = OrderedDict()
+        for path in paths:
+            try:
+                attributes = lstat(path)
+            except OSError:
+                stats[path] = None
+                continue
+            digest = None
+            if md5 and S_ISREG(attributes.st_mode):
+                digest = md5_hash()
+                with open(path, "rb") as local_file:
+                    for chunk in iter(lambda: local_file.read(READ_SIZE), b""):
+                        digest.update(chunk)
+                digest = digest.hexdigest()
+            stats[path] = FileStat(attributes.st_size, S_IMODE(attributes.st_mode), int(attributes.st_mtime),
+                                   file_type(attributes.st_mode), digest)
+        return stats
 
     def do_pull(self, local_path, remote_path):
         copyfile(remote_path, local_path)
 
-    def do_push(self, local_path, remote_path):
+    def do_push(self, local_path, remote_path, mode=None):
         copyfile(local_path, remote_path)
+        if mode is not None:
+            chmod(remote_path, mode)
 
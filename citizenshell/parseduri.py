@@ -1,8 +1,7 @@
-from uritools import urisplit
-
 class ParsedUri:
 
     def __init__(self, uri=None, **kwargs):
+        from uritools import urisplit
         parsed_uri = urisplit(uri or "local://")
         self.scheme = parsed_uri.scheme
         self.kwargs = dict(kwargs)
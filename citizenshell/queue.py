@@ -1,4 +1,16 @@
 try:
-    from Queue import Queue, Empty
+    from Queue import Queue as BaseQueue, Empty
 except:
-    from queue import Queue, Empty
+    from queue import Queue as BaseQueue, Empty
+
+
+class Queue(BaseQueue):
+
+    def __init__(self, *args, **kwargs):
+        BaseQueue.__init__(self, *args, **kwargs)
+        self.on_put = None
+
+    def _put(self, item):
+        BaseQueue._put(self, item)
+        if self.on_put:
+            self.on_put()
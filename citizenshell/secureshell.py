@@ -1,28 +1,71 @@
-import sys
-if sys.version_info.major == 2:
-    from warnings import filterwarnings
-    filterwarnings("ignore", module=".*paramiko.*")
-
-from paramiko import SSHClient, AutoAddPolicy
+from paramiko import SSHClient, SFTPClient, AutoAddPolicy, ChannelException, SSHException
 from .abstractremoteshell import AbstractRemoteShell
 from .shellresult import ShellResult
 from .queue import Queue
-from .streamreader import StandardStreamReader
-from threading import Thread
+from .streamreader import PrefixedStreamReader, PipelinedStreamReader
+from .streamselector import StreamSelector
 from scp import SCPClient
-from time import sleep
+from time import sleep, time
+from threading import Condition, Lock, Thread
+from os import chmod, stat
+from uuid import uuid4
 from logging import CRITICAL
+import tarfile
+
+SFTP_BLOCK_SIZE = 32 * 1024
+SESSION_RETRY_DELAY = 1.0
+SESSION_RETRY_MAX_DELAY = 60.0
+
+
+def read_by_window(remote_file, size, requests):
+    # NOTE: each window of read requests is sent at once and then collected, the
+    #       bounded prefetch of paramiko polls for free slots and is much slower
+    offset = 0
+    while offset < size:
+        window = []
+        while offset < size and len(window) < requests:
+            window.append( (offset, min(SFTP_BLOCK_SIZE, size - offset)) )
+            offset += SFTP_BLOCK_SIZE
+        for data in remote_file.readv(window):
+            yield data
+
+
+def write_pipelined(remote_file, data, pending, requests, last=False):
+    # NOTE: paramiko does not bound the number of pipelined writes in flight, once a
+    #       window worth of them has been sent the next write goes unpipelined, and
+    #       paramiko then collects and checks the answers to every write sent before
+    pending += len(data)
+    synchronous = last or pending >= requests * SFTP_BLOCK_SIZE
+    remote_file.set_pipelined(not synchronous)
+    remote_file.write(data)
+    return 0 if synchronous else pending
+
 
 class SecureShell(AbstractRemoteShell):
 
-    def __init__(self, hostname, username, password=None, port=22,
-                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+    def __init__(self, hostname, username, password=None, port=22, persistent=False, max_sessions=10,
+                 sftp_requests=64, transfer_channels=4, progress=None, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         super(SecureShell, self).__init__(hostname, check_xc=check_xc, check_err=check_err,
-                                          wait=wait, log_level=log_level, **kwargs)
+                                          wait=wait, log_level=log_level, timeout=timeout, **kwargs)
         self._hostname = hostname
         self._port = port
         self._username = username
         self._password = password
+        self._persistent = persistent
+        self._channel = None
+        self._persistent_lock = Lock()
+        self._persistent_reader = None
+        self._max_sessions = max_sessions
+        self._session_limit = max_sessions
+        self._limit_expiry = None
+        self._retry_delay = SESSION_RETRY_DELAY
+        self._refused_at = None
+        self._open_sessions = 0
+        self._sessions = Condition()
+        self._sftp_requests = sftp_requests
+        self._transfer_channels = transfer_channels
+        self._progress = progress
+        self._sftp_available = True
         self.connect()
 
     def do_connect(self):
@@ -30,30 +73,272 @@ class SecureShell(AbstractRemoteShell):
         self._client.load_system_host_keys()
         self._client.set_missing_host_key_policy(AutoAddPolicy())
         self._client.connect(hostname=self._hostname, port=self._port, username=self._username, password=self._password)
-        self._scp_client = SCPClient(self._client.get_transport())
+        if self._persistent:
+            self._open_shell_channel()
 
     def do_disconnect(self):
+        if self._channel is not None:
+            self._stdin.close()
+            self._stdout.close()
         self._client.close()
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
+    def _open_shell_channel(self):
+        self._channel = self._client.get_transport().open_session()
+        self._channel.set_combine_stderr(True)
+        self._channel.exec_command("/bin/sh")
+        self._stdin = self._channel.makefile("wb")
+        self._stdout = self._channel.makefile("r")
+
+    def _current_session_limit(self):
+        if self._limit_expiry is not None and time() >= self._limit_expiry:
+            self._session_limit, self._limit_expiry = self._max_sessions, None
+        return self._session_limit
+
+    def _open_session(self):
+        # NOTE: a server refuses channels beyond its MaxSessions, commands wait for one of
+        #       ours to finish instead, the limit learned that way only holds for a while
+        #       (longer after each refusal) since the refusal may have been a passing one
+        while True:
+            with self._sessions:
+                while self._open_sessions >= self._current_session_limit():
+                    self._sessions.wait(max(0, self._limit_expiry - time()) if self._limit_expiry else None)
+                self._open_sessions += 1
+                opened = self._open_sessions
+            try:
+                channel = self._client.get_transport().open_session()
+            except ChannelException:
+                with self._sessions:
+                    self._open_sessions -= 1
+                    if self._open_sessions == 0:
+                        raise
+                    self._session_limit, self._refused_at = self._open_sessions, opened
+                    self._limit_expiry = time() + self._retry_delay
+                    self._retry_delay = min(self._retry_delay * 2, SESSION_RETRY_MAX_DELAY)
+                continue
+            except Exception:
+                self._close_session(None)
+                raise
+            with self._sessions:
+                if self._refused_at is not None and opened >= self._refused_at:
+                    self._retry_delay, self._refused_at = SESSION_RETRY_DELAY, None
+            return channel
+
+    def _close_session(self, channel):
+        if channel is not None:
+            channel.close()
+        with self._sessions:
+            self._open_sessions -= 1
+            self._sessions.notify()
+
+    def readline(self):
+        line = self._stdout.readline()
+        if not line or line.rstrip("\r\n") == self._sentinel:
+            return None
+        return line
+
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        if self._persistent:
+            return self.execute_persistent_command(command, env, wait, check_err, cwd, retain, chunk_size, timeout)
         for var, val in env.items():
             command = "%s=%s; " % (var, val) + command
-        chan = self._client.get_transport().open_session()
-        chan.exec_command( (("cd \"%s\"; " % cwd) if cwd else "") + command)
+        chan = self._open_session()
+        try:
+            chan.exec_command( (("cd \"%s\"; " % cwd) if cwd else "") + command)
+        except Exception:
+            self._close_session(chan)
+            raise
         queue = Queue()
-        StandardStreamReader(chan.makefile("r"), 1, queue)
-        StandardStreamReader(chan.makefile_stderr("r"), 2, queue)
-        def post_process_exit_code():
-            queue.put( (0, chan.recv_exit_status()) )
-            queue.put( (0, None) )
-        Thread(target=post_process_exit_code).start()
-        return ShellResult(self, command, queue, wait, check_err)
+        selector = StreamSelector.instance()
+        watcher = selector.watch_channel(chan, queue, chunk_size, lambda: self._close_session(chan))
+        # NOTE: closing the channel hangs the remote command up, the selector then ends
+        #       its streams and gives its session back
+        return ShellResult(self, command, queue, wait, check_err, retain, lambda: selector.cancel(watcher), timeout=timeout)
+
+    def execute_persistent_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        wrapped_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
+        queue = Queue()
+        with self._persistent_lock:
+            self._write_persistent(wrapped_command)
+            self._persistent_reader = reader = PrefixedStreamReader(self, queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        if not self._persistent:
+            return super(SecureShell, self).execute_pipeline(commands, env, wait, check_err, cwd, retain, timeout)
+        tags, wrapped_commands = PipelinedStreamReader.wrap_commands(commands, env, cwd)
+        queues = [ Queue() for _ in commands ]
+        with self._persistent_lock:
+            self._write_persistent(wrapped_commands)
+            self._persistent_reader = reader = PipelinedStreamReader(self, zip(tags, queues))
+        return [ ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+                 for command, queue in zip(commands, queues) ]
+
+    def _write_persistent(self, wrapped_command):
+        # NOTE: the shell channel carries one command at a time, concurrent callers
+        #       wait for the output of the previous command to be read entirely
+        if self._persistent_reader is not None:
+            self._persistent_reader.join()
+        # NOTE: a syntax error is fatal for a non-interactive shell, in which case
+        #       we transparently open a new one for the next command
+        if self._channel.closed or self._channel.exit_status_ready():
+            self._open_shell_channel()
+        self._sentinel = "EOC-" + uuid4().hex.upper()
+        self._stdin.write(("%s < /dev/null\necho %s\n" % (wrapped_command, self._sentinel)).encode("utf-8"))
+        self._stdin.flush()
+
+    def _open_sftp(self):
+        # NOTE: None means that the server refused the sftp subsystem on a healthy connection,
+        #       any other failure is raised and sftp is given another chance next time
+        channel = self._open_session()
+        try:
+            try:
+                channel.invoke_subsystem("sftp")
+            except SSHException:
+                if not self._client.get_transport().is_active():
+                    raise
+                self._close_session(channel)
+                return None
+            return SFTPClient(channel)
+        except Exception:
+            self._close_session(channel)
+            raise
+
+    def _with_sftp(self, transfer, *args):
+        # NOTE: servers without the sftp subsystem are remembered and served over scp
+        if self._sftp_available:
+            sftp = self._open_sftp()
+            if sftp is None:
+                self._sftp_available = False
+            else:
+                try:
+                    return transfer(sftp, *args)
+                finally:
+                    self._close_session(sftp.get_channel())
+        return transfer(None, *args)
+
+    def _pull_file(self, sftp, local_path, remote_path):
+        if sftp is None:
+            return SCPClient(self._client.get_transport()).get(remote_path, local_path)
+        with sftp.open(remote_path, "rb") as remote_file:
+            attributes = remote_file.stat()
+            size = attributes.st_size
+            transferred = 0
+            with open(local_path, "wb") as local_file:
+                for data in read_by_window(remote_file, size, self._sftp_requests):
+                    local_file.write(data)
+                    transferred += len(data)
+                    if self._progress:
+                        self._progress(remote_path, transferred, size)
+        return attributes.st_mode & 0o7777
+
+    def _push_file(self, sftp, local_path, remote_path, mode=None):
+        if sftp is None:
+            SCPClient(self._client.get_transport()).put(local_path, remote_path)
+            if mode is not None:
+                self.set_permissions(remote_path, mode)
+            return
+        size = stat(local_path).st_size
+        transferred, pending = 0, 0
+        with open(local_path, "rb") as local_file:
+            with sftp.open(remote_path, "wb") as remote_file:
+                while True:
+                    data = local_file.read(SFTP_BLOCK_SIZE)
+                    if not data:
+                        break
+                    transferred += len(data)
+                    pending = write_pipelined(remote_file, data, pending, self._sftp_requests, transferred >= size)
+                    if self._progress:
+                        self._progress(remote_path, transferred, size)
+        if mode is not None:
+            sftp.chmod(remote_path, mode)
+
+    def _write_file_blocks(self, sftp, remote_path, blocks):
+        if sftp is None:
+            return super(SecureShell, self).write_blocks(remote_path, blocks)
+        pending = 0
+        with sftp.open(remote_path, "r+b") as remote_file:
+            for index, chunk in blocks:
+                remote_file.seek(index * self.DELTA_BLOCK_SIZE)
+                pending = write_pipelined(remote_file, chunk, pending, self._sftp_requests)
+
+    def _transfer_all(self, sftp, transfer, transfers, errors):
+        while True:
+            try:
+                local_path, remote_path = transfers.pop(0)
+            except IndexError:
+                break
+            try:
+                transfer(sftp, local_path, remote_path)
+            except Exception as e:
+                errors.append(e)
+
+    def _transfer_worker(self, transfer, transfers, errors):
+        try:
+            self._with_sftp(self._transfer_all, transfer, transfers, errors)
+        except Exception as e:
+            errors.append(e)
+
+    def _transfer_many(self, transfer, transfers):
+        # NOTE: the files are spread over several sftp channels, each one
+        #       owned by a thread transferring files one after the other
+        transfers, errors = list(transfers), []
+        workers = [ Thread(target=self._transfer_worker, args=(transfer, transfers, errors))
+                    for _ in range(min(self._transfer_channels, len(transfers))) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def _pull_with_permissions(self, sftp, local_path, remote_path):
+        self.log_oob("'%s' <- '%s'" % (local_path, remote_path))
+        permissions = self._pull_file(sftp, local_path, remote_path)
+        chmod(local_path, permissions if permissions is not None else self.get_permissions(remote_path))
+
+    def _push_with_permissions(self, sftp, local_path, remote_path):
+        self.log_oob("'%s' -> '%s'" % (local_path, remote_path))
+        self._push_file(sftp, local_path, remote_path, stat(local_path).st_mode & 0o777)
+
+    def pull_many(self, transfers):
+        self._transfer_many(self._pull_with_permissions, transfers)
+
+    def push_many(self, transfers):
+        self._transfer_many(self._push_with_permissions, transfers)
 
     def do_pull(self, local_path, remote_path):
-        self._scp_client.get(remote_path, local_path)
+        return self._with_sftp(self._pull_file, local_path, remote_path)
+
+    def do_push(self, local_path, remote_path, mode=None):
+        self._with_sftp(self._push_file, local_path, remote_path, mode)
+
+    def write_blocks(self, remote_path, blocks):
+        self._with_sftp(self._write_file_blocks, remote_path, blocks)
+
+    def do_push_tree(self, local_path, remote_path, compress):
+        # NOTE: the archive is streamed straight into tar on a channel of its own
+        chan = self._open_session()
+        try:
+            chan.exec_command(self.untar_command(remote_path, compress))
+            stdin = chan.makefile("wb")
+            with tarfile.open(fileobj=stdin, mode="w|gz" if compress else "w|") as archive:
+                archive.add(local_path, arcname=".")
+            stdin.flush()
+            chan.shutdown_write()
+            stdin.close()
+            stderr = chan.makefile_stderr("r")
+            errors = stderr.read().decode("utf-8", "replace")
+            stderr.close()
+            exit_code = chan.recv_exit_status()
+        finally:
+            self._close_session(chan)
+        if exit_code != 0:
+            raise RuntimeError("could not push '%s': %s" % (local_path, errors.strip()))
 
-    def do_push(self, local_path, remote_path):
-        self._scp_client.put(local_path, remote_path)
+    def do_interrupt(self):
+        # NOTE: without a terminal there is no Ctrl-C, the shell channel is closed instead
+        #       and the next command transparently opens a new one
+        self._channel.close()
 
     def do_reboot(self):
         self("reboot > /dev/null 2>&1 &")
@@ -1,20 +1,25 @@
 from .abstractremoteshell import AbstractRemoteShell
-from .streamreader import PrefixedStreamReader
+from .streamreader import PrefixedStreamReader, PipelinedStreamReader
 from .shellresult import ShellResult
 from .shellerror import ShellError
 from .queue import Queue
 
-from time import sleep
+from time import sleep, time
 from serial import serial_for_url, EIGHTBITS, PARITY_NONE
 from uuid import uuid4
+from threading import Event, Thread
 from logging import CRITICAL
 
+READ_TIMEOUT = .1
+LOGIN_TIMEOUT = .5
+WRITE_SIZE = 4096
+
 class SerialShell(AbstractRemoteShell):
 
     def __init__(self, port, baudrate=115200, bytesize=EIGHTBITS, parity=PARITY_NONE, username=None, password=None,
-                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL,**kwargs):
+                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         super(SerialShell, self).__init__(port, check_xc=check_xc, check_err=check_err,
-                                          wait=wait, log_level=log_level, **kwargs)
+                                          wait=wait, log_level=log_level, timeout=timeout, **kwargs)
         self._prompt = self.id() + '# '
         self._port = port
         self._baudrate = baudrate
@@ -25,12 +30,12 @@ class SerialShell(AbstractRemoteShell):
         self.connect()
 
     def do_connect(self):
-        self._serial = serial_for_url(self._port, baudrate=self._baudrate, parity=self._parity, bytesize=self._bytesize)
+        self._buffer = bytearray()
+        self._serial = serial_for_url(self._port, baudrate=self._baudrate, parity=self._parity, bytesize=self._bytesize,
+                                      timeout=READ_TIMEOUT)
         if self._username:
-            self._write("\n" * 3)
-            sleep(.1)
-            out = self._read_available()
-            if not out.endswith("login: "):
+            self._write("\n")
+            if self._read_until("login: ", LOGIN_TIMEOUT) is None:
                 self._write("exit\n")
                 self._read_until("login: ")
             self._write(self._username + "\n")
@@ -38,15 +43,18 @@ class SerialShell(AbstractRemoteShell):
                 self._read_until("Password: ")
                 self._write(self._password + "\n")
 
-        sleep(.1)
-        self._write("export PS1='%s'\n" % self._prompt)
-        self._read_until(self._prompt)
+        self._synchronize("export PS1='%s'; export COLUMNS=1024; stty columns 1024" % self._prompt)
         self._read_until(self._prompt)
 
-        self._write("export COLUMNS=1024\n")
-        self._read_until(self._prompt)
-        self._write("stty columns 1024\n")
-        self._read_until(self._prompt)
+    def _synchronize(self, command, timeout=1, retries=10):
+        # NOTE: input typed before the shell is ready might be discarded, so the
+        #       command is sent again until the echo of its marker comes back
+        echo_marker, marker = PrefixedStreamReader.make_marker("SYN")
+        for _ in range(retries):
+            self._write("%s; %s\n" % (command, echo_marker))
+            if self._read_until(marker, timeout) is not None:
+                return
+        raise RuntimeError("could not synchronize with '%s'" % self._target)
 
     def do_disconnect(self):
         self._write("exit\n")
@@ -54,34 +62,53 @@ class SerialShell(AbstractRemoteShell):
 
     def _write(self, text):
         self.log_spy_write(text)
-        self._serial.write(text.encode("utf-8"))
-        self._serial.flush()
-
-    def _read_available(self):
-        out = b''
-        while self._serial.in_waiting:
-            out += self._read_string(self._serial.in_waiting)
-        if hasattr(out, "decode"):
-            out = out.decode()
-        self.log_spy_read(out)
-        return out
-
-    def _read_string(self, n):
-        chunk = self._serial.read(n)
-        return chunk
-
-    def _read_until(self, markers):
+        data = text.encode("utf-8")
+        if len(data) <= WRITE_SIZE:
+            self._serial.write(data)
+            self._serial.flush()
+            return
+        # NOTE: large writes (push windows, archives) are echoed back while they are sent,
+        #       the echo is drained meanwhile so that neither side of the line stalls
+        done, echo = Event(), bytearray()
+        def drain():
+            while not done.is_set():
+                echo.extend(self._serial.read(max(1, self._serial.in_waiting)))
+        drainer = Thread(target=drain)
+        drainer.start()
+        try:
+            self._serial.write(data)
+            self._serial.flush()
+        finally:
+            done.set()
+            drainer.join()
+            self._buffer += echo
+
+    def _fill_buffer(self):
+        # NOTE: blocks for at most READ_TIMEOUT waiting for the first byte,
+        #       then drains whatever else is already waiting in one call
+        self._buffer += self._serial.read(max(1, self._serial.in_waiting))
+
+    def _read_until(self, markers, timeout=None):
         if isinstance(markers, str):
             markers = [ markers ]
-        out = b''
+        markers = [ marker.encode("utf-8") for marker in markers ]
+        deadline = (time() + timeout) if timeout is not None else None
+        scanned = 0
         while True:
-            out += self._read_string(1)
-            for i in range(len(markers)):
-                if out.endswith(markers[i].encode("utf-8")):
-                    if hasattr(out, "decode"):
-                        out = out.decode()
-                    self.log_spy_read(out)
-                    return (i, out)
+            found, end = None, None
+            for i, marker in enumerate(markers):
+                index = self._buffer.find(marker, max(0, scanned - len(marker) + 1))
+                if index != -1 and (end is None or index + len(marker) < end):
+                    found, end = i, index + len(marker)
+            if found is not None:
+                out = bytes(self._buffer[:end]).decode()
+                del self._buffer[:end]
+                self.log_spy_read(out)
+                return (found, out)
+            scanned = len(self._buffer)
+            if deadline is not None and time() > deadline:
+                return None
+            self._fill_buffer()
 
     def readline(self):
         (index, line) = self._read_until([ "\n", self._prompt ])
@@ -89,19 +116,30 @@ class SerialShell(AbstractRemoteShell):
             return None
         return line
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
         # NOTE(cme): need to re-export the prompt because the serial line might be shared
         #            bewteen several instance of SerialShell to the same tty
-        self._write("export PS1='\n%s'\n" % self._prompt)
-        self._read_until(self._prompt)
-        self._read_until(self._prompt)
-        self._write(PrefixedStreamReader.wrap_command(command, env, cwd))
-        sleep(.1)
-        self._read_available()
-        self._write("\n")
+        echo_marker, marker = PrefixedStreamReader.make_marker("SOC")
+        wrapped_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
+        self._write("export PS1='\n%s'; %s; %s\n" % (self._prompt, echo_marker, wrapped_command))
+        self._read_until(marker)
         queue = Queue()
-        PrefixedStreamReader(self, queue)
-        return ShellResult(self, command, queue, wait, check_err)
+        reader = PrefixedStreamReader(self, queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        echo_marker, marker = PrefixedStreamReader.make_marker("SOC")
+        tags, wrapped_commands = PipelinedStreamReader.wrap_commands(commands, env, cwd)
+        self._write("export PS1='\n%s'; %s; %s\n" % (self._prompt, echo_marker, wrapped_commands))
+        self._read_until(marker)
+        queues = [ Queue() for _ in commands ]
+        reader = PipelinedStreamReader(self, zip(tags, queues))
+        return [ ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+                 for command, queue in zip(commands, queues) ]
+
+    def do_interrupt(self):
+        # NOTE: Ctrl-C on the terminal, the prompt comes back once the command is dead
+        self._write("\x03")
 
     def do_reboot(self):
         self._write("reboot\n")
@@ -1,26 +1,28 @@
 from .parseduri import ParsedUri
-from .telnetshell import TelnetShell
-from .localshell import LocalShell
-from .secureshell import SecureShell
-from .adbshell import AdbShell
-from .serialshell import SerialShell
 from logging import CRITICAL
 
 def Shell(uri=None, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+    # NOTE: backends are imported on demand, each one pulls its own transport
+    #       library (paramiko, pyserial, ...) that other users should not pay for
     parsed_uri = ParsedUri(uri, check_xc=check_xc, check_err=check_err, wait=wait,
                            log_level=log_level, **kwargs)
     if parsed_uri.scheme == "local":
+        from .localshell import LocalShell
         return LocalShell(**parsed_uri.kwargs)
     elif parsed_uri.scheme == "telnet":
+        from .telnetshell import TelnetShell
         return TelnetShell(hostname=parsed_uri.hostname, username=parsed_uri.username,
                            password=parsed_uri.password, port=parsed_uri.port, **parsed_uri.kwargs)
     elif parsed_uri.scheme == "ssh":
+        from .secureshell import SecureShell
         return SecureShell(hostname=parsed_uri.hostname, username=parsed_uri.username,
                            password=parsed_uri.password, port=parsed_uri.port, **parsed_uri.kwargs)
     elif parsed_uri.scheme == "adb":
+        from .adbshell import AdbShell
         return AdbShell(hostname=parsed_uri.hostname, port=parsed_uri.port, device=parsed_uri.device,
                         **parsed_uri.kwargs)
     elif parsed_uri.scheme == "serial":
+        from .serialshell import SerialShell
         return SerialShell(port=parsed_uri.port, username=parsed_uri.username,
                            password=parsed_uri.password, baudrate=parsed_uri.baudrate, **parsed_uri.kwargs)
 
@@ -10,3 +10,13 @@ class ShellError(RuntimeError):
 
     def exit_code(self):
         return self._problem
+
+
+class ShellTimeout(ShellError):
+
+    def __init__(self, command, timeout):
+        self._timeout = timeout
+        super(ShellTimeout, self).__init__(command, "timeout after %s seconds" % timeout)
+
+    def timeout(self):
+        return self._timeout
@@ -0,0 +1,242 @@
+from .shell import Shell
+from .shellerror import ShellError, ShellTimeout
+from .shellresult import make_storage
+from .queue import Queue, Empty
+from collections import OrderedDict
+from threading import Thread, Lock, Timer
+
+
+class FanoutResult(object):
+
+    def __init__(self, command, keys, timeout, on_timeout, retain="all"):
+        self._command = command
+        self._events = Queue()
+        self._timeout = timeout
+        self._on_timeout = on_timeout
+        self._results = OrderedDict((key, None) for key in keys)
+        self._timers = {}
+        self._done = set()
+        self._expired = set()
+        self._reported = 0
+        self._lock = Lock()
+        self._combined = make_storage(retain)
+        self._finished = False
+
+    def start(self, key):
+        # NOTE: deadlines are enforced by timers, whether anybody consumes the output or not
+        if self._timeout is not None:
+            timer = Timer(self._timeout, self._expire, (key,))
+            timer.daemon = True
+            with self._lock:
+                self._timers[key] = timer
+            timer.start()
+
+    def feed(self, key, fd, line):
+        self._events.put( (key, fd, line) )
+
+    def finish(self, key, result):
+        with self._lock:
+            if key in self._done:
+                return  # late result of a target that timed out
+            self._results[key] = result
+            self._done.add(key)
+            timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._events.put( (key, "done", None) )
+
+    def timed_out(self, key):
+        with self._lock:
+            return key in self._expired
+
+    def _expire(self, key):
+        with self._lock:
+            if key in self._done:
+                return
+            self._results[key] = ShellTimeout(self._command, self._timeout)
+            self._done.add(key)
+            self._expired.add(key)
+            self._timers.pop(key, None)
+        self._on_timeout(key)
+        self._events.put( (key, "done", None) )
+
+    def iter_combined(self):
+        if self._finished:
+            for entry in self._combined or []:
+                yield entry
+            return
+        while self._reported < len(self._results):
+            key, kind, data = self._events.get()
+            if kind == "done":
+                self._reported += 1
+                continue
+            if self.timed_out(key):
+                continue  # late output of a target that timed out
+            if self._combined is not None:
+                self._combined.append( (key, kind, data) )
+            yield (key, kind, data)
+        self._finished = True
+
+    def iter_stdout(self):
+        for key, fd, line in self.iter_combined():
+            if fd == 1:
+                yield (key, line)
+
+    def iter_stderr(self):
+        for key, fd, line in self.iter_combined():
+            if fd == 2:
+                yield (key, line)
+
+    def wait(self):
+        for _ in self.iter_combined():
+            pass
+
+    def command(self):
+        return self._command
+
+    def results(self):
+        self.wait()
+        return OrderedDict(self._results)
+
+    def succeeded(self):
+        return [ key for key, result in self.results().items() if not isinstance(result, Exception) and result ]
+
+    def failed(self):
+        return [ key for key in self.results() if key not in self.succeeded() ]
+
+    def __iter__(self):
+        return self.iter_stdout()
+
+    def __getitem__(self, key):
+        return self.results()[key]
+
+    def __repr__(self):
+        return "%s('%s', %s)" % (self.__class__.__name__, self.command(), list(self._results))
+
+
+class ShellGroup(object):
+
+    def __init__(self, targets, max_workers=16, timeout=None, pool=None, **kwargs):
+        self._targets = OrderedDict((self.key(target), target) for target in targets)
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._pool = pool
+        self._kwargs = kwargs
+        self._shells = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def key(target):
+        # NOTE: shells are dicts, hence not hashable, they are identified by their id instead
+        return target if isinstance(target, str) else target.id()
+
+    def keys(self):
+        return list(self._targets)
+
+    def __call__(self, cmd, check_xc=False, check_err=None, wait=True, timeout=None, retain="all", **kwargs):
+        timeout = timeout if timeout is not None else self._timeout
+        work = Queue()
+        for key in self._targets:
+            work.put(key)
+
+        def on_timeout(key):
+            self._drop(key)
+            # NOTE: the worker stuck on the target is replaced to keep the pool at full size
+            self._start_worker(work, result, cmd, check_xc, check_err, retain, kwargs)
+
+        result = FanoutResult(cmd, list(self._targets), timeout, on_timeout, retain)
+        for _ in range(min(self._max_workers, len(self._targets))):
+            self._start_worker(work, result, cmd, check_xc, check_err, retain, kwargs)
+        if wait:
+            result.wait()
+        return result
+
+    def close(self):
+        # NOTE: pooled shells belong to the pool, the ones still running go back to it when done
+        with self._lock:
+            owned = [ key for key in self._shells if not self._pooled(key) ]
+            shells = [ self._shells.pop(key) for key in owned ]
+        for shell in shells:
+            shell.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_worker(self, work, result, cmd, check_xc, check_err, retain, kwargs):
+        worker = Thread(target=self._work, args=(work, result, cmd, check_xc, check_err, retain, kwargs))
+        worker.daemon = True
+        worker.start()
+
+    def _acquire(self, key):
+        target = self._targets[key]
+        if not isinstance(target, str):
+            return target
+        with self._lock:
+            shell = self._shells.get(key)
+        if self._pool is not None:
+            shell = self._pool.acquire(target, **self._kwargs)
+        elif shell is None or (hasattr(shell, "is_connected") and not shell.is_connected()):
+            shell = Shell(target, **self._kwargs)
+        with self._lock:
+            self._shells[key] = shell
+        return shell
+
+    def _pooled(self, key):
+        return self._pool is not None and isinstance(self._targets[key], str)
+
+    def _release(self, key, shell):
+        if not self._pooled(key):
+            return
+        with self._lock:
+            if self._shells.get(key) is not shell:
+                return  # NOTE: the target timed out and its shell was discarded already
+            del self._shells[key]
+        self._pool.release(shell)
+
+    def _drop(self, key):
+        # NOTE: a shell that timed out is in an unknown state, it is closed, and a
+        #       pooled one is discarded rather than handed back to the pool
+        with self._lock:
+            shell = self._shells.pop(key, None)
+        if shell is None:
+            return
+        try:
+            if self._pooled(key):
+                self._pool.discard(shell)
+            else:
+                shell.close()
+        except Exception:
+            pass
+
+    def _work(self, work, result, cmd, check_xc, check_err, retain, kwargs):
+        while True:
+            try:
+                key = work.get_nowait()
+            except Empty:
+                return
+            result.start(key)
+            shell = None
+            try:
+                shell = self._acquire(key)
+                shell_result = shell(cmd, check_xc=False, check_err=check_err, wait=False, retain=retain, **kwargs)
+                for fd, line in shell_result.iter_combined():
+                    result.feed(key, fd, line)
+                if check_xc and shell_result.exit_code() != 0:
+                    raise ShellError(cmd, "exit code '%s'" % str(shell_result.exit_code()))
+                result.finish(key, shell_result)
+            except Exception as e:
+                result.finish(key, e)
+            finally:
+                if shell is not None:
+                    self._release(key, shell)
+            if result.timed_out(key):
+                return  # a replacement worker was started in the meantime
+
+
+def fanout(targets, cmd, max_workers=16, timeout=None, shell_kwargs=None, **kwargs):
+    # NOTE: kwargs are the environment of the command, like for any shell call, the
+    #       options of the shells themselves (password, port, pool...) go in shell_kwargs
+    return ShellGroup(targets, max_workers=max_workers, timeout=timeout, **(shell_kwargs or {}))(cmd, **kwargs)
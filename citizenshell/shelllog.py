@@ -0,0 +1,64 @@
+from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO, ERROR
+import sys
+
+# NOTE: channel -> (level, stream, prefix, color, attributes)
+CHANNELS = {
+    "in": (INFO, "stdout", "$ ", "cyan", ["bold"]),
+    "out": (INFO, "stdout", "", None, []),
+    "err": (ERROR, "stderr", "", "red", ["bold"]),
+    "oob": (INFO, "stdout", "> ", "yellow", ["bold"]),
+    "spy.read": (DEBUG, "stdout", "<<< ", "magenta", ["bold"]),
+    "spy.write": (DEBUG, "stdout", ">>> ", "green", ["bold"]),
+}
+
+
+class ColoredFormatter(Formatter):
+
+    def __init__(self, prefix, color, attrs):
+        super(ColoredFormatter, self).__init__()
+        self._prefix = prefix
+        self._color = color
+        self._attrs = attrs
+        self._template = None
+
+    def format(self, record):
+        if self._template is None:
+            from termcolor import colored
+            self._template = colored(self._prefix, attrs=self._attrs) + colored("%s", color=self._color,
+                                                                                attrs=self._attrs)
+        return self._template % record.getMessage()
+
+
+class StandardStreamHandler(StreamHandler):
+
+    def __init__(self, stream_name):
+        super(StandardStreamHandler, self).__init__()
+        self._stream_name = stream_name
+
+    def emit(self, record):
+        # NOTE: sys.stdout/sys.stderr are looked up for each record, they may have been replaced
+        #       (output capture, redirection, ...) since the handler was built
+        self.stream = getattr(sys, self._stream_name)
+        super(StandardStreamHandler, self).emit(record)
+
+
+def build_logger(channel):
+    level, stream, prefix, color, attrs = CHANNELS[channel]
+    logger = getLogger("citizenshell.%s" % channel)
+    # NOTE: filtering is done by each shell according to its own log level
+    logger.setLevel(DEBUG)
+    if not logger.handlers:
+        handler = StandardStreamHandler(stream)
+        handler.setFormatter(ColoredFormatter(prefix, color, attrs))
+        logger.addHandler(handler)
+    return logger
+
+
+LOGGERS = dict((channel, build_logger(channel)) for channel in CHANNELS)
+LEVELS = dict((channel, CHANNELS[channel][0]) for channel in CHANNELS)
+
+
+def log(channel, shell_id, text):
+    # NOTE: records are tagged with the id of the shell that emitted them so that
+    #       they can be told apart (or filtered) despite sharing the same loggers
+    LOGGERS[channel].log(LEVELS[channel], text, extra={"shell_id": shell_id})
@@ -0,0 +1,154 @@
+from .parseduri import ParsedUri
+from .shell import Shell
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+
+
+class ShellPool(object):
+
+    def __init__(self, max_per_target=4, idle_timeout=300, health_check=True, **kwargs):
+        self._max_per_target = max_per_target
+        self._idle_timeout = idle_timeout
+        self._health_check = health_check
+        self._kwargs = kwargs
+        self._condition = Condition()
+        self._idle = {}
+        self._counts = {}
+        self._keys = {}
+        self._acquired = set()
+        self._closed = False
+
+    def key(self, uri=None, **kwargs):
+        # NOTE: different spellings of the same target (default port, adb+tcp vs adb, ...)
+        #       end up with the same key once parsed
+        options = dict(self._kwargs)
+        options.update(kwargs)
+        parsed_uri = ParsedUri(uri, **options)
+        return (parsed_uri.scheme, getattr(parsed_uri, "hostname", None),
+                parsed_uri.port, parsed_uri.username, parsed_uri.password, parsed_uri.device,
+                parsed_uri.baudrate, repr(sorted(parsed_uri.kwargs.items())))
+
+    def acquire(self, uri=None, timeout=None, **kwargs):
+        key = self.key(uri, **kwargs)
+        deadline = None if timeout is None else time() + timeout
+        self.evict_idle()
+        while True:
+            shell = self._reserve(uri, key, timeout, deadline)
+            if shell is None:
+                break
+            if not self._health_check or self._is_healthy(shell):
+                return shell
+            self._discard(key, shell)
+        try:
+            options = dict(self._kwargs)
+            options.update(kwargs)
+            shell = Shell(uri, **options)
+        except Exception:
+            self._discard(key, None)
+            raise
+        with self._condition:
+            self._keys[id(shell)] = key
+            self._acquired.add(id(shell))
+        return shell
+
+    def release(self, shell):
+        with self._condition:
+            key = self._checked_in(shell)
+            closed = self._closed
+            if not closed:
+                self._idle.setdefault(key, []).append((shell, time()))
+                self._condition.notify_all()
+        if closed:
+            # NOTE: shells still in use when the pool was closed are closed when they come back
+            return self._discard(key, shell)
+        self.evict_idle()
+
+    def discard(self, shell):
+        with self._condition:
+            key = self._checked_in(shell)
+        self._discard(key, shell)
+
+    @contextmanager
+    def shell(self, uri=None, timeout=None, **kwargs):
+        shell = self.acquire(uri, timeout, **kwargs)
+        try:
+            yield shell
+        finally:
+            self.release(shell)
+
+    def evict_idle(self, idle_timeout=None):
+        idle_timeout = self._idle_timeout if idle_timeout is None else idle_timeout
+        evicted = []
+        with self._condition:
+            now = time()
+            for key, entries in self._idle.items():
+                kept = [ (shell, since) for shell, since in entries if now - since < idle_timeout ]
+                evicted += [ (key, shell) for shell, since in entries if now - since >= idle_timeout ]
+                entries[:] = kept
+        for key, shell in evicted:
+            self._discard(key, shell)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.evict_idle(idle_timeout=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _checked_in(self, shell):
+        # NOTE: a shell handed back twice would end up twice in the idle list,
+        #       and be handed out to two callers at once
+        if id(shell) not in self._keys:
+            raise RuntimeError("%s does not belong to this pool" % repr(shell))
+        if id(shell) not in self._acquired:
+            raise RuntimeError("%s was already released" % repr(shell))
+        self._acquired.discard(id(shell))
+        return self._keys[id(shell)]
+
+    def _reserve(self, uri, key, timeout, deadline):
+        # NOTE: returns an idle shell, or None once a slot has been reserved
+        #       for a new one, the connection itself is made outside of the lock
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("cannot acquire '%s' from a closed pool" % uri)
+                idle = self._idle.get(key)
+                if idle:
+                    shell = idle.pop()[0]
+                    self._acquired.add(id(shell))
+                    return shell
+                if self._counts.get(key, 0) < self._max_per_target:
+                    self._counts[key] = self._counts.get(key, 0) + 1
+                    return None
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError("no shell available for '%s' after %s seconds" % (uri, timeout))
+                self._condition.wait(remaining)
+
+    def _discard(self, key, shell):
+        with self._condition:
+            self._counts[key] -= 1
+            if shell is not None:
+                self._keys.pop(id(shell), None)
+                self._acquired.discard(id(shell))
+            self._condition.notify_all()
+        if shell is not None:
+            try:
+                shell.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_healthy(shell):
+        try:
+            if hasattr(shell, "is_connected") and not shell.is_connected():
+                return False
+            return shell.execute_command("true", retain="none").exit_code() == 0
+        except Exception:
+            return False
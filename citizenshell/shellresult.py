@@ -1,75 +1,156 @@
-from .shellerror import ShellError
+from .shellerror import ShellError, ShellTimeout
+from .queue import Empty
+from collections import deque
+from time import time
 
-class ShellResult():
 
-    def __init__(self, shell, command, queue, wait, check_err):
+class tail(object):
+
+    def __init__(self, count):
+        self.count = count
+
+    def __repr__(self):
+        return "tail(%d)" % self.count
+
+
+def make_deadline(timeout):
+    return None if timeout is None else (time() + timeout, timeout)
+
+
+def earliest_deadline(*deadlines):
+    deadlines = [ deadline for deadline in deadlines if deadline is not None ]
+    return min(deadlines) if deadlines else None
+
+
+def make_storage(retain):
+    if retain == "all":
+        return []
+    elif retain == "none":
+        return None
+    elif isinstance(retain, tail):
+        return deque(maxlen=retain.count)
+    raise ValueError("unknown retention policy '%s', expected 'all', 'none' or tail(N)" % (retain,))
+
+
+class AbstractShellResult(object):
+
+    def __init__(self, shell, command, queue, wait, check_err, retain="all", canceller=None, timeout=None, log_stdin=True):
         self._shell = shell
         self._command = command
         self._queue = queue
-        self._combined = []
+        self._combined = make_storage(retain)
         self._xc = None
         self._finished = False
         self._wait = wait
         self._check_err = check_err
-        self._shell.log_stdin(command)
+        self._canceller = canceller
+        self._deadline = make_deadline(timeout)
+        self._timed_out = None
+        self._open_streams = set([0, 1, 2])
+        self._err_detected = None
+        self._shell.track_result(self)
+        if log_stdin:
+            self._shell.log_stdin(command)
+
+    def _feed(self, fd, line):
+        # NOTE: the queue carries (fd, line) pairs, fd 0 being the exit code, a None line
+        #       closes its stream and an exception ends them all, True means (fd, line) is
+        #       to be yielded, and _check(fd, line) to be called after that
+        if isinstance(line, Exception):
+            raise line
+        if line is None:
+            self._open_streams.discard(fd)
+            return False
+        if fd == 0:
+            self._xc = line
+            return False
+        if self._combined is not None:
+            self._combined.append( (fd, line) )
+        return True
+
+    def _check(self, fd, line):
+        if fd == 1:
+            if not isinstance(line, bytes):
+                self._shell.log_stdout(line)
+        elif fd == 2:
+            self._shell.log_stderr(line)
+            if self._check_err:
+                self._err_detected = ShellError(self.command(), "stderr '%s'" % line)
+                if not self._wait:
+                    err_detected, self._err_detected = self._err_detected, None
+                    raise err_detected
+
+    def _finish(self):
+        self._finished = True
+        if self._err_detected:
+            raise self._err_detected
+
+    def _expire(self, deadline):
+        # NOTE: a deadline is a (time, timeout) pair, the timeout is only there to be reported,
+        #       the output of a cancelled command may never come, the result is considered
+        #       dead and keeps raising the same error
+        self.cancel()
+        self._timed_out = ShellTimeout(self.command(), deadline[1])
+        raise self._timed_out
+
+    def cancel(self):
+        # NOTE: the command is only interrupted, its output still ends the usual way
+        #       and can be consumed (or ignored) after that, the exit code tells how it died
+        if not self._finished and self._canceller:
+            self._canceller()
+            self._canceller = None
+
+    def command(self):
+        return self._command
+
+
+class ShellResult(AbstractShellResult):
+
+    def __init__(self, shell, command, queue, wait, check_err, retain="all", canceller=None, timeout=None):
+        super(ShellResult, self).__init__(shell, command, queue, wait, check_err, retain, canceller, timeout)
         if wait: self.wait()
 
-    def iter_combined(self):
+    def _get(self, deadline):
+        if self._timed_out:
+            raise self._timed_out
+        if deadline is None:
+            return self._queue.get()
+        try:
+            return self._queue.get(timeout=max(0, deadline[0] - time()))
+        except Empty:
+            self._expire(deadline)
+
+    def iter_combined(self, timeout=None):
         if self._finished:
-            for entry in self._combined:
+            for entry in self._combined or []:
                 yield entry
         else:
-            err_detected = None
-            out_left, err_left, process_finished = True, True, False
-            while out_left or err_left or not process_finished:
-                fd, line = self._queue.get()
-
-                if isinstance(line, Exception):
-                    raise line
-
-                if line is None:
-                    if fd == 1: out_left = False
-                    if fd == 2: err_left = False
-                    if fd == 0: process_finished = True
-                    continue
-
-                if fd == 0:
-                    self._xc = line
-                    continue
-
-                self._combined.append( (fd, line) )
-                yield (fd, line)
-
-                if fd == 1:
-                    self._shell.log_stdout(line)
-                elif fd == 2:
-                    self._shell.log_stderr(line)
-                    if self._check_err:
-                        err_detected = ShellError(self.command(), "stderr '%s'" % line)
-                        if not self._wait:
-                            raise err_detected  # pylint: disable-msg=E0702
-
-            self._finished = True
-            if err_detected:
-                raise err_detected  # pylint: disable-msg=E0702
-
-    def iter_stdout(self):
-        for fd, line in self.iter_combined():
+            deadline = earliest_deadline(self._deadline, make_deadline(timeout))
+            while self._open_streams:
+                fd, line = self._get(deadline)
+                if self._feed(fd, line):
+                    yield (fd, line)
+                    self._check(fd, line)
+            self._finish()
+
+    def iter_stdout(self, timeout=None):
+        for fd, line in self.iter_combined(timeout):
             if fd == 1:
                 yield line
 
-    def iter_stderr(self):
-        for fd, line in self.iter_combined():
+    def iter_chunks(self, timeout=None):
+        # NOTE: in binary mode stdout is made of raw bytes chunks instead of lines
+        return self.iter_stdout(timeout)
+
+    def iter_stderr(self, timeout=None):
+        for fd, line in self.iter_combined(timeout):
             if fd == 2:
                 yield line
 
-    def wait(self):
-        for _ in iter(self):
+    def wait(self, timeout=None):
+        for _ in self.iter_combined(timeout):
             pass
 
-    def command(self):
-        return self._command
-
     def stdout(self):
         return list(self.iter_stdout())
 
@@ -79,8 +160,8 @@ class ShellResult():
     def combined(self):
         return list(self.iter_combined())
 
-    def exit_code(self):
-        self.wait()
+    def exit_code(self, timeout=None):
+        self.wait(timeout)
         return self._xc
 
     def __iter__(self):
@@ -1,6 +1,8 @@
 from threading import Thread
 from .queue import Queue
 from time import sleep
+from uuid import uuid4
+from binascii import a2b_base64
 
 class StandardStreamReader(Thread):
 
@@ -28,21 +30,34 @@ class StandardStreamReader(Thread):
 class PrefixedStreamReader(Thread):
 
     @staticmethod
-    def wrap_command(command, environment, cwd=None):
+    def wrap_command(command, environment, cwd=None, binary=False, tag=""):
         result = command
         for var, val in environment.items():
             result = "%s=%s; " % (var, val) + result
         if cwd:
             result = ("cd \"%s\"; " % cwd) + result
         prefix_filter = 'while IFS= read -r line || [ -n "$line" ]; do echo %s"$line"; done'
-        out_filter = prefix_filter % "OUT-"
-        err_filter = prefix_filter % "ERR-"
-        return "{ { { (%s) 2>&3; echo XC--$? >&4; } | %s >&2; } 3>&1 4>&2 1>&2 | %s; } 2>&1" % (result.strip(), out_filter, err_filter)
+        out_filter = prefix_filter % ("OUT-" + tag)
+        err_filter = prefix_filter % ("ERR-" + tag)
+        if binary:
+            # NOTE: the terminal would mangle raw bytes, stdout is encoded on the remote end
+            #       and decoded by the reader, the exit code is still the one of the command
+            out_filter = "base64 | " + out_filter
+        return "{ { { (%s) 2>&3; echo XC--%s$? >&4; } | %s >&2; } 3>&1 4>&2 1>&2 | %s; } 2>&1" % (result.strip(), tag, out_filter, err_filter)
 
-    def __init__(self, input_stream, output_queue):
+    @staticmethod
+    def make_marker(prefix):
+        # NOTE: the quotes keep the echo of the command typed on a tty from
+        #       matching the marker, only its output does
+        token = uuid4().hex.upper()
+        return ("echo '%s-'%s" % (prefix, token), "%s-%s" % (prefix, token))
+
+    def __init__(self, input_stream, output_queue, chunk_size=None):
         super(PrefixedStreamReader, self).__init__()
         self.input_stream = input_stream
         self.output_queue = output_queue
+        self.chunk_size = chunk_size
+        self.pending = bytearray()
         self.start()
 
     def readline(self, r_retries = 3):
@@ -56,6 +71,32 @@ class PrefixedStreamReader(Thread):
                 sleep(.1)
         raise caught # pylint: disable-msg=E0702
 
+    def put_chunk(self, data):
+        self.pending += data
+        while len(self.pending) >= self.chunk_size:
+            self.output_queue.put( (1, bytes(self.pending[:self.chunk_size])) )
+            del self.pending[:self.chunk_size]
+
+    def dispatch(self, prefix, line):
+        if prefix == "ERR-":
+            self.output_queue.put( (2, line) )
+        elif prefix == "OUT-" and self.chunk_size:
+            self.put_chunk(a2b_base64(line))
+        elif prefix == "OUT-":
+            self.output_queue.put( (1, line) )
+        elif prefix == "XC--":
+            self.output_queue.put( (0, int(line)) )
+
+    def close(self):
+        if self.pending:
+            self.output_queue.put( (1, bytes(self.pending)) )
+        self.output_queue.put( (1, None) )
+        self.output_queue.put( (2, None) )
+        self.output_queue.put( (0, None) )
+
+    def fail(self, error):
+        self.output_queue.put( (0, error) )
+
     def run(self):
         try:
             while True:
@@ -65,16 +106,59 @@ class PrefixedStreamReader(Thread):
                 if hasattr(line, "decode"):
                     line = line.decode('utf-8')
                 line = line.rstrip("\r\n")
-                prefix, line = line[:4], line[4:]
-                if prefix == "ERR-":
-                    self.output_queue.put( (2, line) )
-                elif prefix == "OUT-":
-                    self.output_queue.put( (1, line) )
-                elif prefix == "XC--":
-                    self.output_queue.put( (0, int(line)) )
-            self.output_queue.put( (1, None) )
-            self.output_queue.put( (2, None) )
-            self.output_queue.put( (0, None) )
+                self.dispatch(line[:4], line[4:])
+            self.close()
         except Exception as e:
-            self.output_queue.put( (0, e) )
+            self.fail(e)
+
+
+class PipelinedStreamReader(PrefixedStreamReader):
+
+    TAG_SIZE = 8
+
+    @classmethod
+    def wrap_commands(cls, commands, environment, cwd=None):
+        # NOTE: the commands are grouped so that the shell parses all of them before
+        #       running any, each one tags its output lines to be routed to its result
+        tags = [ "%0*X" % (cls.TAG_SIZE, i) for i in range(len(commands)) ]
+        wrapped = [ PrefixedStreamReader.wrap_command(command, environment, cwd, tag=tag)
+                    for command, tag in zip(commands, tags) ]
+        return (tags, "{\n%s\n}" % "\n".join(wrapped))
+
+    def __init__(self, input_stream, output_queues):
+        output_queues = list(output_queues)
+        self.output_queues = dict(output_queues)
+        self.open_tags = [ tag for tag, _ in output_queues ]
+        super(PipelinedStreamReader, self).__init__(input_stream, None)
+
+    def close_until(self, tag):
+        # NOTE: the exit code bypasses the prefix filters and can come before the last
+        #       lines of its command, which is only known to be complete once the output
+        #       of the next one shows up
+        while self.open_tags and self.open_tags[0] != tag:
+            output_queue = self.output_queues.pop(self.open_tags.pop(0))
+            output_queue.put( (1, None) )
+            output_queue.put( (2, None) )
+            output_queue.put( (0, None) )
+
+    def dispatch(self, prefix, line):
+        tag, line = line[:self.TAG_SIZE], line[self.TAG_SIZE:]
+        if tag not in self.output_queues:
+            return
+        self.close_until(tag)
+        output_queue = self.output_queues[tag]
+        if prefix == "ERR-":
+            output_queue.put( (2, line) )
+        elif prefix == "OUT-":
+            output_queue.put( (1, line) )
+        elif prefix == "XC--":
+            output_queue.put( (0, int(line)) )
+
+    def close(self):
+        # NOTE: commands that never reported an exit code, because the shell
+        #       exited before running them for instance, end up without one
+        self.close_until(None)
 
+    def fail(self, error):
+        for output_queue in self.output_queues.values():
+            output_queue.put( (0, error) )
@@ -0,0 +1,258 @@
+from selectors import DefaultSelector, EVENT_READ
+from threading import Thread, Lock
+from os import pipe, read, write, getpid
+
+READ_SIZE = 64 * 1024
+MIN_POLL_DELAY = 0.001
+MAX_POLL_DELAY = 0.05
+
+
+class LineBuffer(object):
+
+    def __init__(self, output_fd, output_queue):
+        self.output_fd = output_fd
+        self.output_queue = output_queue
+        self.pending = b""
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.output_queue.put( (self.output_fd, line.decode("utf-8").rstrip("\r")) )
+
+    def close(self):
+        if self.pending:
+            self.output_queue.put( (self.output_fd, self.pending.decode("utf-8").rstrip("\r")) )
+        self.output_queue.put( (self.output_fd, None) )
+
+
+class ChunkBuffer(object):
+
+    def __init__(self, output_fd, output_queue):
+        self.output_fd = output_fd
+        self.output_queue = output_queue
+
+    def feed(self, data):
+        self.output_queue.put( (self.output_fd, data) )
+
+    def close(self):
+        self.output_queue.put( (self.output_fd, None) )
+
+
+def make_stdout_buffer(output_queue, chunk_size):
+    return ChunkBuffer(1, output_queue) if chunk_size else LineBuffer(1, output_queue)
+
+
+class ProcessWatcher(object):
+
+    def __init__(self, process, output_queue, chunk_size=None):
+        self.process = process
+        self.output_queue = output_queue
+        self.streams = {
+            process.stdout.fileno(): (process.stdout, make_stdout_buffer(output_queue, chunk_size), chunk_size or READ_SIZE),
+            process.stderr.fileno(): (process.stderr, LineBuffer(2, output_queue), READ_SIZE),
+        }
+
+    def register(self, selector):
+        for fd in self.streams:
+            selector.register(fd, EVENT_READ, self)
+
+    def on_readable(self, selector, fd):
+        stream, line_buffer, read_size = self.streams[fd]
+        data = read(fd, read_size)
+        if data:
+            line_buffer.feed(data)
+        else:
+            selector.unregister(fd)
+            del self.streams[fd]
+            stream.close()
+            line_buffer.close()
+
+    def on_error(self, selector, error):
+        for fd, (stream, _, _) in self.streams.items():
+            selector.unregister(fd)
+            stream.close()
+        self.streams = {}
+        self.output_queue.put( (0, error) )
+
+    def waiting_for_exit_code(self):
+        return not self.streams
+
+    def exited(self):
+        pass
+
+    def poll_exit_code(self):
+        if self.streams:
+            return False
+        exit_code = self.process.poll()
+        if exit_code is None:
+            return False
+        self.output_queue.put( (0, exit_code) )
+        self.output_queue.put( (0, None) )
+        return True
+
+
+class ChannelWatcher(object):
+
+    def __init__(self, channel, output_queue, chunk_size=None, on_exit=None):
+        self.channel = channel
+        self.output_queue = output_queue
+        self.on_exit = on_exit
+        self.read_size = chunk_size or READ_SIZE
+        self.stdout = make_stdout_buffer(output_queue, chunk_size)
+        self.stderr = LineBuffer(2, output_queue)
+        self.eof = False
+
+    def register(self, selector):
+        selector.register(self.channel.fileno(), EVENT_READ, self)
+
+    def drain(self):
+        while self.channel.recv_ready():
+            self.stdout.feed(self.channel.recv(self.read_size))
+        while self.channel.recv_stderr_ready():
+            self.stderr.feed(self.channel.recv_stderr(READ_SIZE))
+
+    def close_streams(self):
+        self.stdout.close()
+        self.stderr.close()
+        self.eof = True
+
+    def on_readable(self, selector, fd):
+        # NOTE: nothing can be received after the EOF, so checking for it before
+        #       draining the buffers guarantees that no data is left behind
+        eof = self.channel.eof_received or self.channel.closed
+        self.drain()
+        if eof:
+            selector.unregister(fd)
+            self.close_streams()
+
+    def cancel(self, selector):
+        # NOTE: closing the channel releases its file descriptor, it has to be unregistered
+        #       first, the exit code is then whatever the server sent before the close
+        if not self.eof:
+            selector.unregister(self.channel.fileno())
+            self.channel.close()
+            self.drain()
+            self.close_streams()
+
+    def on_error(self, selector, error):
+        if not self.eof:
+            selector.unregister(self.channel.fileno())
+            self.eof = True
+        self.exited()
+        self.output_queue.put( (0, error) )
+
+    def exited(self):
+        if self.on_exit:
+            self.on_exit()
+            self.on_exit = None
+
+    def waiting_for_exit_code(self):
+        return self.eof
+
+    def poll_exit_code(self):
+        if not self.eof or not self.channel.exit_status_ready():
+            return False
+        exit_code = self.channel.recv_exit_status()
+        self.exited()
+        self.output_queue.put( (0, exit_code) )
+        self.output_queue.put( (0, None) )
+        return True
+
+
+class StreamSelector(Thread):
+
+    _instance = None
+    _instance_lock = Lock()
+
+    @classmethod
+    def instance(cls):
+        # NOTE: the thread does not survive a fork, so a child process gets its own
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance._pid != getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        super(StreamSelector, self).__init__(name="citizenshell-selector")
+        self.daemon = True
+        self._pid = getpid()
+        self._selector = DefaultSelector()
+        self._lock = Lock()
+        self._incoming = []
+        self._cancelled = []
+        self._watchers = []
+        self._poll_delay = MIN_POLL_DELAY
+        self._wakeup_read, self._wakeup_write = pipe()
+        self._selector.register(self._wakeup_read, EVENT_READ, None)
+        self.start()
+
+    def watch_process(self, process, output_queue, chunk_size=None):
+        self._submit(ProcessWatcher(process, output_queue, chunk_size))
+
+    def watch_channel(self, channel, output_queue, chunk_size=None, on_exit=None):
+        watcher = ChannelWatcher(channel, output_queue, chunk_size, on_exit)
+        self._submit(watcher)
+        return watcher
+
+    def cancel(self, watcher):
+        # NOTE: watched streams are only ever closed by the selector thread, one closed
+        #       behind its back would silently vanish from the selector
+        with self._lock:
+            self._cancelled.append(watcher)
+        write(self._wakeup_write, b"*")
+
+    def _submit(self, watcher):
+        with self._lock:
+            self._incoming.append(watcher)
+        write(self._wakeup_write, b"*")
+
+    def _cancel_requested(self):
+        with self._lock:
+            cancelled, self._cancelled = self._cancelled, []
+        for watcher in cancelled:
+            if watcher not in self._watchers:
+                continue  # already done, or never registered
+            try:
+                watcher.cancel(self._selector)
+            except Exception as e:
+                watcher.on_error(self._selector, e)
+
+    def _register_incoming(self):
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for watcher in incoming:
+            try:
+                watcher.register(self._selector)
+                self._watchers.append(watcher)
+            except Exception as e:
+                watcher.exited()
+                watcher.output_queue.put( (0, e) )
+        if incoming:
+            self._poll_delay = MIN_POLL_DELAY
+
+    def _poll_exit_codes(self):
+        watchers = [ watcher for watcher in self._watchers if not watcher.poll_exit_code() ]
+        if len(watchers) == len(self._watchers):
+            self._poll_delay = min(self._poll_delay * 2, MAX_POLL_DELAY)
+        else:
+            self._poll_delay = MIN_POLL_DELAY
+        self._watchers = watchers
+
+    def run(self):
+        while True:
+            # NOTE: exit codes cannot be selected on, they are polled with an increasing
+            #       delay as long as at least one stream has been closed without one
+            waiting = any(watcher.waiting_for_exit_code() for watcher in self._watchers)
+            timeout = self._poll_delay if waiting else None
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    read(self._wakeup_read, READ_SIZE)
+                    continue
+                try:
+                    key.data.on_readable(self._selector, key.fd)
+                except Exception as e:
+                    key.data.on_error(self._selector, e)
+            self._register_incoming()
+            self._cancel_requested()
+            self._poll_exit_codes()
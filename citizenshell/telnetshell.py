@@ -1,19 +1,18 @@
 from telnetlib import Telnet
 from time import sleep
-from sys import version_info
 
 from .abstractremoteshell import AbstractRemoteShell
 from .shellresult import ShellResult
-from .streamreader import PrefixedStreamReader
+from .streamreader import PrefixedStreamReader, PipelinedStreamReader
 from .queue import Queue
 from logging import CRITICAL
 
 class TelnetShell(AbstractRemoteShell):
 
     def __init__(self, hostname, username, password=None, port=23,
-                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, **kwargs):
+                 check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
         super(TelnetShell, self).__init__(hostname, check_xc=check_xc, check_err=check_err,
-                                          wait=wait, log_level=log_level, **kwargs)
+                                          wait=wait, log_level=log_level, timeout=timeout, **kwargs)
         self._prompt = self._id
         self._hostname = hostname
         self._username = username
@@ -31,16 +30,18 @@ class TelnetShell(AbstractRemoteShell):
         if self._password:
             self._read_until("Password: ")
             self._write(self._password + "\n")
-        sleep(.1)
-
-        self._write("export PS1='%s'\n" % self._prompt)
-        self._read_until(self._prompt)
-        self._read_until(self._prompt)
-        self._write("export COLUMNS=1024\n")
-        self._read_until(self._prompt)
-        self._write("stty columns 1027\n")
+        self._synchronize("export PS1='%s'; export COLUMNS=1024; stty columns 1027" % self._prompt)
         self._read_until(self._prompt)
 
+    def _synchronize(self, command, timeout=1, retries=10):
+        # NOTE: input typed before the shell is ready might be discarded, so the
+        #       command is sent again until the echo of its marker comes back
+        echo_marker, marker = PrefixedStreamReader.make_marker("SYN")
+        for _ in range(retries):
+            self._write("%s; %s\n" % (command, echo_marker))
+            if self._read_until(marker, timeout).endswith(marker.encode("utf-8")):
+                return
+        raise RuntimeError("could not synchronize with '%s'" % self._target)
 
     def do_disconnect(self):
         self._telnet.close()
@@ -49,28 +50,41 @@ class TelnetShell(AbstractRemoteShell):
         self.log_spy_write(text)
         self._telnet.write(text.encode('utf-8'))
 
-    def _read_until(self, marker):
-        out = self._telnet.read_until(marker.encode('utf-8'))
+    def _read_until(self, marker, timeout=None):
+        out = self._telnet.read_until(marker.encode('utf-8'), timeout)
         self.log_spy_read(out)
         return out
 
     def readline(self):
-        choices = [ "\n", self._prompt ]
-        if version_info[0] > 2: choices = [ bytes(x, 'utf-8') for x in choices ]
+        choices = [ x.encode('utf-8') for x in [ "\n", self._prompt ] ]
         (index, _, line) = self._telnet.expect(choices)
         self.log_spy_read(line.decode('utf-8').rstrip("\n\r"))
         if index == 0:
             return line
         return None
 
-    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None):
-        wrapped_command = PrefixedStreamReader.wrap_command(command, env, cwd)
-        self._write(wrapped_command + "\n")
-        self.readline()
-        sleep(.2)
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        wrapped_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
+        echo_marker, marker = PrefixedStreamReader.make_marker("SOC")
+        self._write("%s; %s\n" % (echo_marker, wrapped_command))
+        self._read_until(marker)
         queue = Queue()
-        PrefixedStreamReader(self, queue)
-        return ShellResult(self, command, queue, wait, check_err)
+        reader = PrefixedStreamReader(self, queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        tags, wrapped_commands = PipelinedStreamReader.wrap_commands(commands, env, cwd)
+        echo_marker, marker = PrefixedStreamReader.make_marker("SOC")
+        self._write("%s; %s\n" % (echo_marker, wrapped_commands))
+        self._read_until(marker)
+        queues = [ Queue() for _ in commands ]
+        reader = PipelinedStreamReader(self, zip(tags, queues))
+        return [ ShellResult(self, command, queue, wait, check_err, retain, self.interrupter(reader), timeout=timeout)
+                 for command, queue in zip(commands, queues) ]
+
+    def do_interrupt(self):
+        # NOTE: Ctrl-C on the terminal, the prompt comes back once the command is dead
+        self._write("\x03")
 
     def do_reboot(self):
         self._write("reboot\n")
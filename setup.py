@@ -1,5 +1,4 @@
 from setuptools import setup
-from sys import version_info
 
 def get_version(rel_path):
     for line in open(rel_path).readlines():
@@ -20,11 +19,6 @@ REQUIREMENTS = [
     'backports.tempfile>=0.4.0'
 ]
 
-if version_info.major == 2:
-    REQUIREMENTS += [
-        'bcrypt==3.1.7'
-    ]
-
 setup(
     name='citizenshell',
     version=VERSION,
@@ -39,6 +33,7 @@ setup(
     long_description_content_type="text/markdown",
     keywords=["shell", "telnet", "adb", "ssh", "serial"],
     download_url="https://github.com/meuter/citizenshell/archive/" + VERSION + ".tar.gz",
+    python_requires=">=3.7",
     install_requires=[
         'termcolor>=1.1.0',
         'paramiko>=2.4.0',
@@ -56,14 +51,14 @@ setup(
         'Operating System :: MacOS :: MacOS X',
         'Operating System :: POSIX',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Utilities',
     ],
 )
@@ -0,0 +1,10 @@
+from pytest import fixture
+from citizenshell.abstractremoteshell import AbstractRemoteShell
+
+
+@fixture(autouse=True)
+def capability_cache(tmp_path, monkeypatch):
+    # NOTE: the tests never read nor write the capability cache of whoever runs them
+    cache_path = str(tmp_path / "capabilities.json")
+    monkeypatch.setattr(AbstractRemoteShell, "CAPABILITY_CACHE", cache_path)
+    return cache_path
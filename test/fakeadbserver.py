@@ -0,0 +1,168 @@
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from subprocess import Popen, STDOUT
+from select import select
+from socket import MSG_PEEK, MSG_DONTWAIT, IPPROTO_TCP, TCP_NODELAY
+from struct import pack, unpack
+from threading import Thread
+from os import lstat, chmod, utime, killpg
+from signal import SIGKILL
+from time import sleep
+
+DEVICE = "fake0"
+
+
+class FakeAdbHandler(BaseRequestHandler):
+    # NOTE: stand-in for an adb server with a single device, the device being this
+    #       very machine: shell services run the local /bin/sh and sync services
+    #       read and write the local filesystem
+
+    def recv_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def send_string(self, text):
+        text = text.encode("utf-8")
+        self.request.sendall(b"%04x" % len(text) + text)
+
+    def okay(self, text=None):
+        self.request.sendall(b"OKAY")
+        if text is not None:
+            self.send_string(text)
+
+    def fail(self, text):
+        self.request.sendall(b"FAIL")
+        self.send_string(text)
+
+    def handle(self):
+        self.request.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        try:
+            while True:
+                service = self.recv_exactly(int(self.recv_exactly(4), 16)).decode("utf-8")
+                if not self.dispatch(service):
+                    return
+        except (EOFError, OSError):
+            pass
+
+    def dispatch(self, service):
+        devices = self.server.devices
+        if service == "host:devices":
+            self.okay("".join("%s\tdevice\n" % device for device in devices))
+        elif service.startswith("host:connect:"):
+            devices.add(service[len("host:connect:"):])
+            self.okay("connected to %s" % service[len("host:connect:"):])
+        elif service.startswith("host:disconnect:"):
+            devices.discard(service[len("host:disconnect:"):])
+            self.okay("disconnected %s" % service[len("host:disconnect:"):])
+        elif service.startswith("host-serial:") and service.endswith(":get-state"):
+            serial = service[len("host-serial:"):-len(":get-state")]
+            if serial in devices:
+                self.okay("device")
+            else:
+                self.fail("device '%s' not found" % serial)
+        elif service.startswith("host:transport:"):
+            if service[len("host:transport:"):] not in devices:
+                self.fail("device '%s' not found" % service[len("host:transport:"):])
+                return False
+            self.okay()
+            return True
+        elif service.startswith("shell:"):
+            self.okay()
+            self.shell(service[len("shell:"):])
+            return False
+        elif service == "sync:":
+            self.okay()
+            self.sync()
+            return False
+        elif service == "root:":
+            self.okay()
+            self.request.sendall(b"adbd is already running as root\n")
+            return False
+        elif service == "reboot:":
+            self.okay()
+            return False
+        else:
+            self.fail("unknown service '%s'" % service)
+        return False
+
+    def shell(self, command):
+        process = Popen(["/bin/sh", "-c", command] if command else ["/bin/sh"], stdin=self.request.fileno(),
+                        stdout=self.request.fileno(), stderr=STDOUT, start_new_session=True)
+        # NOTE: like adbd, the command is hung up when the client closes its socket
+        while process.poll() is None:
+            if select([self.request], [], [], .005)[0]:
+                try:
+                    closed = self.request.recv(1, MSG_PEEK | MSG_DONTWAIT) == b""
+                except BlockingIOError:
+                    closed = False
+                if closed:
+                    try:
+                        killpg(process.pid, SIGKILL)
+                    except OSError:
+                        pass
+                    process.wait()
+                    break
+                sleep(.005)
+
+    def sync_send(self, message_id, payload=b""):
+        self.request.sendall(message_id + pack("<I", len(payload)) + payload)
+
+    def sync(self):
+        while True:
+            header = self.recv_exactly(8)
+            message_id, length = header[:4], unpack("<I", header[4:])[0]
+            if message_id == b"QUIT":
+                return
+            payload = self.recv_exactly(length).decode("utf-8")
+            if message_id == b"STAT":
+                try:
+                    attributes = lstat(payload)
+                    self.request.sendall(b"STAT" + pack("<III", attributes.st_mode, attributes.st_size & 0xffffffff,
+                                                        int(attributes.st_mtime)))
+                except OSError:
+                    self.request.sendall(b"STAT" + pack("<III", 0, 0, 0))
+            elif message_id == b"SEND":
+                path, _, mode = payload.rpartition(",")
+                data = b""
+                while True:
+                    header = self.recv_exactly(8)
+                    message_id, length = header[:4], unpack("<I", header[4:])[0]
+                    if message_id == b"DONE":
+                        break
+                    data += self.recv_exactly(length)
+                try:
+                    with open(path, "wb") as remote_file:
+                        remote_file.write(data)
+                    chmod(path, int(mode) & 0o7777)
+                    utime(path, (length, length))
+                    self.sync_send(b"OKAY")
+                except OSError as e:
+                    self.sync_send(b"FAIL", str(e).encode("utf-8"))
+            elif message_id == b"RECV":
+                try:
+                    with open(payload, "rb") as remote_file:
+                        for chunk in iter(lambda: remote_file.read(64 * 1024), b""):
+                            self.sync_send(b"DATA", chunk)
+                    self.request.sendall(b"DONE" + pack("<I", 0))
+                except OSError as e:
+                    self.sync_send(b"FAIL", str(e).encode("utf-8"))
+            else:
+                self.sync_send(b"FAIL", b"unknown sync message")
+
+
+class FakeAdbServer(ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ("localhost", 0), FakeAdbHandler)
+        self.devices = set([DEVICE])
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def address(self):
+        return "localhost:%d" % self.server_address[1]
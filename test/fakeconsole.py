@@ -0,0 +1,86 @@
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from threading import Thread
+from select import select
+from os import execve, read, write, close, kill, waitpid, environ
+from pty import fork
+from signal import SIGKILL
+
+USERNAME = "fake"
+PASSWORD = "fake"
+
+
+class FakeConsoleHandler(BaseRequestHandler):
+    # NOTE: stand-in for a serial console or a telnet server, the socket is relayed to
+    #       an interactive /bin/sh running on a terminal of its own on this very machine
+
+    def read_line(self):
+        line = b""
+        while not line.endswith(b"\n"):
+            data = self.request.recv(1)
+            if not data:
+                raise EOFError()
+            line += data
+        return line.strip().decode("utf-8")
+
+    def login(self):
+        while True:
+            self.request.sendall(b"\r\nlogin: ")
+            username = self.read_line()
+            self.request.sendall(b"Password: ")
+            if (username, self.read_line()) == (USERNAME, PASSWORD):
+                return
+
+    def handle(self):
+        try:
+            if self.server.login:
+                self.login()
+        except (EOFError, OSError):
+            return
+        pid, terminal = fork()
+        if pid == 0:
+            env = dict(environ, PS1="$ ", TERM="dumb")
+            execve("/bin/sh", ["/bin/sh", "-i"], env)
+        try:
+            self.relay(terminal)
+        finally:
+            try:
+                kill(pid, SIGKILL)
+            except OSError:
+                pass
+            waitpid(pid, 0)
+            close(terminal)
+
+    def relay(self, terminal):
+        while True:
+            readable = select([self.request, terminal], [], [])[0]
+            if self.request in readable:
+                data = self.request.recv(64 * 1024)
+                if not data:
+                    return
+                while data:
+                    data = data[write(terminal, data):]
+            if terminal in readable:
+                try:
+                    data = read(terminal, 64 * 1024)
+                except OSError:
+                    data = b""
+                if not data:
+                    return  # the shell exited
+                self.request.sendall(data)
+
+
+class FakeConsole(ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, login=False):
+        ThreadingTCPServer.__init__(self, ("localhost", 0), FakeConsoleHandler)
+        self.login = login
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def port(self):
+        return self.server_address[1]
+
+    def url(self):
+        return "socket://localhost:%d" % self.port()
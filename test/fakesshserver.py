@@ -0,0 +1,214 @@
+from paramiko import (Transport, ServerInterface, RSAKey, SFTPServer, SFTPServerInterface, SFTPHandle,
+                      SFTPAttributes, SFTP_OK, AUTH_SUCCESSFUL, AUTH_FAILED, OPEN_SUCCEEDED,
+                      OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED)
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from subprocess import Popen, PIPE
+from threading import Thread, Lock
+from os import (O_CREAT, O_WRONLY, O_RDWR, O_APPEND, open as os_open, fdopen, stat, lstat, fstat, listdir,
+                remove, rename, mkdir, rmdir, readlink, symlink, killpg, path)
+from signal import SIGKILL
+from time import sleep
+
+USERNAME = "fake"
+PASSWORD = "fake"
+HOST_KEY = RSAKey.generate(2048)
+
+
+class FakeSftpHandle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class FakeSftpInterface(SFTPServerInterface):
+    # NOTE: serves the local filesystem, like the shell sessions run the local /bin/sh
+
+    def list_folder(self, remote_path):
+        try:
+            return [ SFTPAttributes.from_stat(lstat(path.join(remote_path, name)), name) for name in listdir(remote_path) ]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, remote_path):
+        try:
+            return SFTPAttributes.from_stat(stat(remote_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, remote_path):
+        try:
+            return SFTPAttributes.from_stat(lstat(remote_path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, remote_path, flags, attr):
+        try:
+            mode = getattr(attr, "st_mode", None)
+            fd = os_open(remote_path, flags, mode if mode is not None else 0o666)
+            if flags & O_CREAT and attr is not None:
+                attr._flags &= ~attr.FLAG_PERMISSIONS
+                SFTPServer.set_file_attr(remote_path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & O_WRONLY:
+            mode = "ab" if flags & O_APPEND else "wb"
+        elif flags & O_RDWR:
+            mode = "a+b" if flags & O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = FakeSftpHandle(flags)
+        handle.filename = remote_path
+        handle.readfile = handle.writefile = fdopen(fd, mode)
+        return handle
+
+    def _apply(self, function, *args):
+        try:
+            function(*args)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def remove(self, remote_path):
+        return self._apply(remove, remote_path)
+
+    def rename(self, old_path, new_path):
+        return self._apply(rename, old_path, new_path)
+
+    def posix_rename(self, old_path, new_path):
+        return self._apply(rename, old_path, new_path)
+
+    def mkdir(self, remote_path, attr):
+        return self._apply(mkdir, remote_path, getattr(attr, "st_mode", None) or 0o777)
+
+    def rmdir(self, remote_path):
+        return self._apply(rmdir, remote_path)
+
+    def chattr(self, remote_path, attr):
+        return self._apply(SFTPServer.set_file_attr, remote_path, attr)
+
+    def symlink(self, target_path, remote_path):
+        return self._apply(symlink, target_path, remote_path)
+
+    def readlink(self, remote_path):
+        try:
+            return readlink(remote_path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class FakeSftpServer(SFTPServer):
+
+    def finish_subsystem(self):
+        SFTPServer.finish_subsystem(self)
+        self.get_server().close_session()
+
+
+class FakeSshInterface(ServerInterface):
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = Lock()
+        self.sessions = 0
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL if (username, password) == (USERNAME, PASSWORD) else AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        # NOTE: like OpenSSH's MaxSessions, sessions beyond the limit are refused
+        with self.lock:
+            if kind != "session" or self.sessions >= self.server.max_sessions:
+                self.server.refused += 1
+                return OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+            self.sessions += 1
+            return OPEN_SUCCEEDED
+
+    def close_session(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def check_channel_exec_request(self, channel, command):
+        Thread(target=self.execute, args=(channel, command.decode("utf-8")), daemon=True).start()
+        return True
+
+    def execute(self, channel, command):
+        process = Popen(["/bin/sh", "-c", command], stdin=PIPE, stdout=PIPE, stderr=PIPE, start_new_session=True)
+        def pump(read, write):
+            for data in iter(lambda: read(32 * 1024), b""):
+                try:
+                    write(data)
+                except (EOFError, OSError):
+                    break
+        def write_stdin(data):
+            process.stdin.write(data)
+            process.stdin.flush()
+        def feed():
+            pump(channel.recv, write_stdin)
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        pumps = [ Thread(target=pump, args=(process.stdout.read1, channel.sendall), daemon=True),
+                  Thread(target=pump, args=(process.stderr.read1, channel.sendall_stderr), daemon=True) ]
+        Thread(target=feed, daemon=True).start()
+        for thread in pumps:
+            thread.start()
+        # NOTE: like sshd, the command is hung up when the client closes its channel
+        while process.poll() is None:
+            if channel.closed:
+                try:
+                    killpg(process.pid, SIGKILL)
+                except OSError:
+                    pass
+            sleep(.005)
+        for thread in pumps:
+            thread.join()
+        try:
+            channel.send_exit_status(process.returncode if process.returncode >= 0 else 128 - process.returncode)
+            channel.shutdown_write()
+        except (EOFError, OSError):
+            pass
+        self.close_session()
+
+
+class FakeSshHandler(BaseRequestHandler):
+
+    def handle(self):
+        transport = Transport(self.request)
+        transport.add_server_key(HOST_KEY)
+        if self.server.sftp:
+            transport.set_subsystem_handler("sftp", FakeSftpServer, FakeSftpInterface)
+        transport.start_server(server=FakeSshInterface(self.server))
+        self.server.connections += 1
+        while transport.is_active():
+            sleep(.05)
+
+
+class FakeSshServer(ThreadingTCPServer):
+    # NOTE: stand-in for an sshd, the host being this very machine
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, max_sessions=10, sftp=True):
+        ThreadingTCPServer.__init__(self, ("localhost", 0), FakeSshHandler)
+        self.max_sessions = max_sessions
+        self.sftp = sftp
+        self.refused = 0
+        self.connections = 0
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def port(self):
+        return self.server_address[1]
@@ -0,0 +1,55 @@
+from citizenshell.abstractremoteshell import AbstractRemoteShell
+from citizenshell.streamreader import PrefixedStreamReader, PipelinedStreamReader
+from citizenshell.shellresult import ShellResult
+from citizenshell.queue import Queue
+from subprocess import Popen, PIPE
+from logging import CRITICAL
+from time import sleep
+
+
+class ProcessOutput(object):
+
+    def __init__(self, process):
+        self._process = process
+
+    def readline(self):
+        line = self._process.stdout.readline()
+        return line if line else None
+
+
+class LoopbackShell(AbstractRemoteShell):
+    # NOTE: stand-in for a remote shell, commands are framed like they would be
+    #       for telnet/serial/adb but are executed by a local /bin/sh, which lets
+    #       us exercise the generic remote code paths without any device. An
+    #       artificial latency can be added to each command to simulate the RTT.
+
+    def __init__(self, latency=0, check_xc=False, check_err=False, wait=True, log_level=CRITICAL, timeout=None, **kwargs):
+        super(LoopbackShell, self).__init__("localhost", check_xc=check_xc, check_err=check_err,
+                                            wait=wait, log_level=log_level, timeout=timeout, **kwargs)
+        self._latency = latency
+        self.connect()
+
+    def do_connect(self):
+        pass
+
+    def do_disconnect(self):
+        pass
+
+    def spawn(self, formatted_command):
+        sleep(self._latency)
+        process = Popen(["/bin/sh"], stdin=PIPE, stdout=PIPE)
+        process.stdin.write((formatted_command + "\n").encode("utf-8"))
+        process.stdin.close()
+        return ProcessOutput(process)
+
+    def execute_command(self, command, env={}, wait=True, check_err=False, cwd=None, retain="all", chunk_size=None, timeout=None):
+        formatted_command = PrefixedStreamReader.wrap_command(command, env, cwd, binary=bool(chunk_size))
+        queue = Queue()
+        PrefixedStreamReader(self.spawn(formatted_command), queue, chunk_size)
+        return ShellResult(self, command, queue, wait, check_err, retain, timeout=timeout)
+
+    def execute_pipeline(self, commands, env={}, wait=True, check_err=False, cwd=None, retain="all", timeout=None):
+        tags, formatted_commands = PipelinedStreamReader.wrap_commands(commands, env, cwd)
+        queues = [ Queue() for _ in commands ]
+        PipelinedStreamReader(self.spawn(formatted_commands), zip(tags, queues))
+        return [ ShellResult(self, command, queue, wait, check_err, retain, timeout=timeout) for command, queue in zip(commands, queues) ]
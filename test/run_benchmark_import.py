@@ -0,0 +1,20 @@
+from subprocess import check_output
+from sys import argv, executable
+
+
+def import_time(statement):
+    # NOTE: each measure runs in a fresh interpreter, the module cache would hide the cost otherwise
+    script = "from time import time; start = time(); %s; print(time() - start)" % statement
+    return float(check_output([executable, "-c", script]))
+
+
+def benchmark(statement, count):
+    timings = sorted(import_time(statement) for _ in range(count))
+    print("%-40s best %6.1f ms, median %6.1f ms" % (statement, timings[0] * 1000, timings[len(timings) // 2] * 1000))
+
+
+if __name__ == "__main__":
+    count = int(argv[1]) if len(argv) > 1 else 10
+    benchmark("import citizenshell", count)
+    benchmark("from citizenshell import sh", count)
+    benchmark("from citizenshell import SecureShell", count)
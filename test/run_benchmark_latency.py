@@ -0,0 +1,41 @@
+from citizenshell import TelnetShell, SerialShell
+from os import environ
+from sys import argv
+from time import time
+
+
+def get_shells():
+    if "TEST_TELNET_HOST" in environ:
+        yield TelnetShell(environ.get("TEST_TELNET_HOST"), username=environ.get("TEST_TELNET_USER"),
+                          password=environ.get("TEST_TELNET_PASS", None),
+                          port=int(environ.get("TEST_TELNET_PORT", 23)))
+    if "TEST_SERIAL_PORT" in environ:
+        yield SerialShell(port=environ.get("TEST_SERIAL_PORT"), username=environ.get("TEST_SERIAL_USER", None),
+                          password=environ.get("TEST_SERIAL_PASS", None),
+                          baudrate=int(environ.get("TEST_SERIAL_BAUDRATE", "115200")))
+
+
+def benchmark(shell, count):
+    start = time()
+    for i in range(count):
+        assert shell("echo %d" % i) == str(i)
+    elapsed = time() - start
+    print("%-12s %5d commands in %7.3f sec -> %7.1f ms/command" % (shell.__class__.__name__, count, elapsed,
+                                                                    elapsed / count * 1000))
+
+
+def benchmark_pipeline(shell, count):
+    start = time()
+    results = shell.pipeline([ "echo %d" % i for i in range(count) ])
+    for i, result in enumerate(results):
+        assert result == str(i)
+    elapsed = time() - start
+    print("%-12s %5d pipelined in %7.3f sec -> %7.1f ms/command" % (shell.__class__.__name__, count, elapsed,
+                                                                     elapsed / count * 1000))
+
+
+if __name__ == "__main__":
+    count = int(argv[1]) if len(argv) > 1 else 100
+    for shell in get_shells():
+        benchmark(shell, count)
+        benchmark_pipeline(shell, count)
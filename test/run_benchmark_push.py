@@ -0,0 +1,41 @@
+from loopbackshell import LoopbackShell
+from citizenshell.abstractremoteshell import octal_escape, read_by_chunk
+from tempfile import NamedTemporaryFile
+from os import urandom
+from sys import argv
+from time import time
+
+
+def legacy_push(shell, local_path, remote_path):
+    shell("rm -f %s" % remote_path)
+    for chunk in read_by_chunk(local_path, 128):
+        shell("printf '%s' >> %s" % (octal_escape(chunk), remote_path))
+
+
+def bulk_push(encoder):
+    def push(shell, local_path, remote_path):
+        shell._available_commands["base64"] = encoder
+        shell.do_push(local_path, remote_path)
+    return push
+
+
+def benchmark(name, push, size, latency):
+    shell = LoopbackShell(latency=latency)
+    remote_path = "/tmp/citizenshell_benchmark_push"
+    with NamedTemporaryFile() as local_file:
+        local_file.write(urandom(size))
+        local_file.flush()
+        start = time()
+        push(shell, local_file.name, remote_path)
+        elapsed = time() - start
+    shell("rm -f %s" % remote_path)
+    print("%-10s %8d bytes in %7.3f sec -> %8.1f KB/s" % (name, size, elapsed, size / elapsed / 1024))
+
+
+if __name__ == "__main__":
+    size = int(argv[1]) if len(argv) > 1 else 1024 * 1024
+    latency = float(argv[2]) if len(argv) > 2 else 0.005
+    print("pushing %d bytes with %.1f ms of simulated latency per command" % (size, latency * 1000))
+    benchmark("legacy", legacy_push, min(size, 64 * 1024), latency)
+    for encoder in ("base64", "printf"):
+        benchmark(encoder, bulk_push(encoder), size, latency)
@@ -1,10 +1,11 @@
 from pytest import mark, raises
-from citizenshell import ShellError
+from citizenshell import ShellError, ShellTimeout, tail
 from logging import INFO, ERROR, DEBUG
 from backports.tempfile import TemporaryDirectory
 from tempfile import NamedTemporaryFile
-from os import path, stat
+from os import path, stat, urandom, makedirs, readlink, symlink, utime
 from uuid import uuid4
+from hashlib import md5
 from time import time
 from os import chmod
 
@@ -215,18 +216,33 @@ class AbstractShellTester:
     def test_shell_logs(self, caplog):
         cmd = ">&2 echo error && echo output && exit 13"
         shell = self.get_shell()
-        base_logger = str(shell)
-        caplog.set_level(INFO, logger="%s.in" % base_logger)
-        caplog.set_level(INFO, logger="%s.out" % base_logger)
-        caplog.set_level(INFO, logger="%s.err" % base_logger)
+        caplog.set_level(INFO, logger="citizenshell")
 
         shell(cmd)
-        in_index = caplog.record_tuples.index(("%s.in" % base_logger, INFO, cmd))
-        out_index = caplog.record_tuples.index(("%s.err" % base_logger, ERROR, "error"))
-        err_index = caplog.record_tuples.index(("%s.out" % base_logger, INFO, "output"))
+        records = [ (record.name, record.levelno, record.getMessage()) for record in caplog.records
+                    if getattr(record, "shell_id", None) == shell.id() ]
+        in_index = records.index(("citizenshell.in", INFO, cmd))
+        out_index = records.index(("citizenshell.err", ERROR, "error"))
+        err_index = records.index(("citizenshell.out", INFO, "output"))
         assert in_index < out_index
         assert in_index < err_index
 
+    def test_shell_command_timeout(self):
+        shell = self.get_shell()
+        start = time()
+        with raises(ShellTimeout):
+            shell("sleep 10", timeout=.5)
+        assert time() - start < 5
+        assert shell("echo Foo", timeout=5) == "Foo"
+
+    def test_shell_result_wait_timeout(self):
+        shell = self.get_shell()
+        result = shell("echo Foo; sleep 10", wait=False)
+        with raises(ShellTimeout):
+            result.wait(.5)
+        with raises(ShellTimeout):
+            result.exit_code()
+
     def test_shell_command_with_single_quotes(self):
         shell = self.get_shell()
         assert shell("echo '$FOO'", FOO="foo") == "$FOO"
@@ -277,6 +293,143 @@ class AbstractShellTester:
         finally:
             shell("rm %s" % remote_path)
 
+    def test_shell_can_push_and_pull_many_files(self):
+        shell = self.get_shell()
+        remote_paths = [ self.get_test_remote_path(shell) for _ in range(5) ]
+        contents = [ urandom(1000 * (i + 1)) for i in range(5) ]
+        try:
+            with TemporaryDirectory() as sandbox:
+                pushed = [ path.join(sandbox, "pushed_%d" % i) for i in range(5) ]
+                pulled = [ path.join(sandbox, "pulled_%d" % i) for i in range(5) ]
+                for i, content in enumerate(contents):
+                    open(pushed[i], "wb").write(content)
+                    chmod(pushed[i], 0o700 + i)
+                shell.push_many(zip(pushed, remote_paths))
+                for i, remote_path in enumerate(remote_paths):
+                    assert shell.get_permissions(remote_path) == 0o700 + i
+                shell.pull_many(zip(pulled, remote_paths))
+                for i, content in enumerate(contents):
+                    assert open(pulled[i], "rb").read() == content
+                    assert (stat(pulled[i]).st_mode & 0o777) == 0o700 + i
+        finally:
+            shell("rm -f %s" % " ".join(remote_paths))
+
+    def test_shell_can_stat_many_paths(self):
+        shell = self.get_shell()
+        directory = self.get_test_remote_path(shell)
+        regular, spaced, link = "%s/regular" % directory, "%s/it's a file" % directory, "%s/link" % directory
+        try:
+            assert shell("mkdir %s && printf 'content' > %s && chmod 640 %s && touch \"%s\" && ln -s regular %s"
+                         % (directory, regular, regular, spaced, link))
+            if shell("touch -d @1000000000 %s" % regular).exit_code() != 0:
+                shell("touch -t 200109090146.40 %s" % regular)
+            stats = shell.stat_many([regular, spaced, directory, link, directory + "/missing"], md5=True)
+            assert list(stats) == [regular, spaced, directory, link, directory + "/missing"]
+            assert stats[regular].size == 7
+            assert stats[regular].mode == 0o640
+            assert stats[regular].type == "file"
+            assert stats[regular].md5 == md5(b"content").hexdigest()
+            if shell.get_command("stat -c", "find -printf", "ls") == "ls":
+                assert stats[regular].mtime is None
+            else:
+                assert stats[regular].mtime == 1000000000
+            assert stats[spaced].size == 0
+            assert stats[directory].type == "directory"
+            assert stats[directory].md5 is None
+            assert stats[link].type == "symlink"
+            assert stats[directory + "/missing"] is None
+            assert shell.stat_many([]) == {}
+        finally:
+            shell("rm -rf %s" % directory)
+
+    def test_shell_can_push_delta(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        block_size = getattr(shell, "DELTA_BLOCK_SIZE", 4096)
+        content = bytearray(urandom(block_size * 5 + 100))
+        try:
+            with NamedTemporaryFile() as temp_file:
+                temp_file.write(content)
+                temp_file.flush()
+                shell.push(temp_file.name, remote_path, delta=True)
+                assert shell.md5(remote_path) == md5(content).hexdigest()
+
+                written = []
+                if hasattr(shell, "write_blocks"):
+                    write_blocks = shell.write_blocks
+                    def spy_write_blocks(path, blocks):
+                        blocks = list(blocks)
+                        written.extend(index for index, _ in blocks)
+                        write_blocks(path, blocks)
+                    shell.write_blocks = spy_write_blocks
+                try:
+                    content[block_size * 2 + 10] ^= 0xFF
+                    content = content[:block_size * 4 + 50]
+                    temp_file.seek(0)
+                    temp_file.truncate()
+                    temp_file.write(content)
+                    temp_file.flush()
+                    shell.push(temp_file.name, remote_path, delta=True)
+                finally:
+                    shell.__dict__.pop("write_blocks", None)
+                assert shell.md5(remote_path) == md5(content).hexdigest()
+                if hasattr(shell, "write_blocks"):
+                    assert written == [2, 4]
+        finally:
+            shell("rm -f %s" % remote_path)
+
+    @mark.parametrize("compress", [False, True])
+    def test_shell_can_push_and_pull_tree(self, compress):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        try:
+            with TemporaryDirectory() as sandbox:
+                pushed, pulled = path.join(sandbox, "pushed"), path.join(sandbox, "pulled")
+                makedirs(path.join(pushed, "sub", "dir"))
+                open(path.join(pushed, "text"), "w").write("this is a file\n")
+                open(path.join(pushed, "sub", "dir", "data"), "wb").write(urandom(100000))
+                symlink("sub/dir/data", path.join(pushed, "link"))
+                chmod(path.join(pushed, "text"), 0o751)
+                chmod(path.join(pushed, "sub", "dir", "data"), 0o600)
+                utime(path.join(pushed, "text"), (1000000000, 1000000000))
+
+                shell.push_tree(pushed, remote_path, compress=compress)
+                assert shell("cat %s/text" % remote_path) == "this is a file"
+                assert shell.get_permissions("%s/text" % remote_path) == 0o751
+                assert shell.get_permissions("%s/sub/dir/data" % remote_path) == 0o600
+                assert shell("readlink %s/link" % remote_path) == "sub/dir/data"
+
+                shell.pull_tree(pulled, remote_path, compress=compress)
+                for name in ["text", path.join("sub", "dir", "data")]:
+                    assert open(path.join(pulled, name), "rb").read() == open(path.join(pushed, name), "rb").read()
+                    assert stat(path.join(pulled, name)).st_mode == stat(path.join(pushed, name)).st_mode
+                assert int(stat(path.join(pulled, "text")).st_mtime) == 1000000000
+                assert readlink(path.join(pulled, "link")) == "sub/dir/data"
+        finally:
+            shell("rm -rf %s" % remote_path)
+
+    def test_shell_push_tree_creates_parents_under_umask(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        umask = int(shell("umask").stdout()[0], 8)
+        try:
+            with TemporaryDirectory() as sandbox:
+                open(path.join(sandbox, "text"), "w").write("this is a file\n")
+                chmod(sandbox, 0o750)
+                shell.push_tree(sandbox, "%s/parent/tree" % remote_path)
+                assert shell.get_permissions(remote_path) == 0o777 & ~umask
+                assert shell.get_permissions("%s/parent" % remote_path) == 0o777 & ~umask
+                assert shell.get_permissions("%s/parent/tree" % remote_path) == 0o750
+        finally:
+            shell("rm -rf %s" % remote_path)
+
+    def test_shell_pull_tree_of_missing_directory_fails(self):
+        shell = self.get_shell()
+        remote_path = self.get_test_remote_path(shell)
+        with TemporaryDirectory() as sandbox:
+            with raises(RuntimeError):
+                shell.pull_tree(sandbox, remote_path)
+
     def test_shell_command_with_empty_outputlines(self):
         shell = self.get_shell()
         result = shell("echo; echo; echo; echo")
@@ -318,6 +471,74 @@ class AbstractShellTester:
         assert result.stderr() == []
         assert result.stdout() == ["bloop" for _ in range(4)]
 
+    def test_shell_result_retain_none(self):
+        shell = self.get_shell()
+        result = shell("for i in 1 2 3 4 5; do echo $i; done; exit 3", wait=False, retain="none")
+        assert list(result) == ["1", "2", "3", "4", "5"]
+        assert result.stdout() == []
+        assert result.exit_code() == 3
+
+    def test_shell_result_retain_none_and_wait(self):
+        shell = self.get_shell()
+        result = shell("echo Foo; exit 3", retain="none")
+        assert list(result) == []
+        assert result.exit_code() == 3
+
+    def test_shell_result_retain_tail(self):
+        shell = self.get_shell()
+        result = shell("for i in 1 2 3 4 5; do echo $i; done; sleep .1; echo error >&2", retain=tail(2))
+        assert result.combined() == [(1, "5"), (2, "error")]
+        assert result.exit_code() == 0
+
+    def test_shell_result_retain_none_and_check_err(self):
+        shell = self.get_shell()
+        with raises(ShellError):
+            shell("echo line; echo error >&2", retain="none", check_err=True)
+
+    def test_shell_pipeline(self):
+        shell = self.get_shell()
+        commands = [ "for j in 1 2 3; do echo %d$j; done; echo err%d >&2; exit %d" % (i, i, i % 3) for i in range(20) ]
+        results = shell.pipeline(commands)
+        assert len(results) == 20
+        for i, result in enumerate(results):
+            assert result.command() == commands[i]
+            assert result.stdout() == [ "%d%d" % (i, j) for j in (1, 2, 3) ]
+            assert result.stderr() == [ "err%d" % i ]
+            assert result.exit_code() == i % 3
+
+    def test_shell_pipeline_with_env_and_cwd(self):
+        shell = self.get_shell()
+        results = shell.pipeline([ "echo $FOO", "pwd" ], cwd="/", FOO="foo")
+        assert [ result.stdout() for result in results ] == [ ["foo"], ["/"] ]
+
+    def test_shell_pipeline_check_xc(self):
+        shell = self.get_shell()
+        with raises(ShellError):
+            shell.pipeline([ "true", "exit 4", "true" ], check_xc=True)
+        assert shell("echo still alive") == "still alive"
+
+    def test_shell_pipeline_check_xc_drains_the_batch(self):
+        shell = self.get_shell()
+        start = time()
+        with raises(ShellError):
+            shell.pipeline([ "exit 4", "sleep .5", "true" ], check_xc=True, wait=False)
+        assert time() - start >= .5
+        assert shell("echo still alive") == "still alive"
+
+    def test_shell_binary_output(self):
+        shell = self.get_shell()
+        result = shell("printf 'a\\000\\r\\n\\377b'; echo error >&2; exit 2", binary=True)
+        assert b"".join(result.iter_chunks()) == b"a\x00\r\n\xffb"
+        assert result.stderr() == ["error"]
+        assert result.exit_code() == 2
+
+    def test_shell_binary_output_chunk_size(self):
+        shell = self.get_shell()
+        result = shell("dd if=/dev/zero bs=1000 count=10 2>/dev/null", binary=True, chunk_size=4096)
+        chunks = list(result.iter_chunks())
+        assert all(isinstance(chunk, bytes) and 0 < len(chunk) <= 4096 for chunk in chunks)
+        assert b"".join(chunks) == bytes(10000)
+
     def test_shell_execute_command_no_wait_and_check_err(self):
         shell = self.get_shell()
         collected = []
@@ -2,6 +2,7 @@ from os import environ
 from citizenshell import AdbShell
 from pytest import skip
 from shelltester import AbstractShellTester
+from fakeadbserver import FakeAdbServer, DEVICE
 from subprocess import check_output
 
 
@@ -45,3 +46,49 @@ class TestAdbShellUsbSpecific(AbstractShellTester):
     def instanciate_new_shell(self, *args, **kwargs):
         device = environ.get("TEST_ADB_DEVICE")
         return AdbShell(device=device, root=True, *args, **kwargs)
+
+
+class TestAdbShellUsbPersistent(TestAdbShellUsbSpecific):
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return super(TestAdbShellUsbPersistent, self).instanciate_new_shell(persistent=True, *args, **kwargs)
+
+    def test_shell_survives_syntax_error(self):
+        shell = self.get_shell()
+        assert shell("echo (").exit_code() is None
+        assert shell("echo Foo") == "Foo"
+
+
+class TestAdbShellServer(AbstractShellTester):
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeAdbServer()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return AdbShell(device=DEVICE, server=self.server.address(), *args, **kwargs)
+
+    def test_server_lists_available_devices(self):
+        assert AdbShell.list_available_devices(server=self.server.address()) == ([DEVICE], [])
+
+    def test_server_connects_remote_device(self):
+        shell = AdbShell(hostname="10.0.0.2", server=self.server.address())
+        assert AdbShell.list_available_devices(server=self.server.address()) == ([DEVICE], ["10.0.0.2:5555"])
+        assert shell("echo Foo") == "Foo"
+        shell.close()
+        assert AdbShell.list_available_devices(server=self.server.address()) == ([DEVICE], [])
+
+
+class TestAdbShellServerPersistent(TestAdbShellServer):
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return super(TestAdbShellServerPersistent, self).instanciate_new_shell(persistent=True, *args, **kwargs)
+
+    def test_shell_survives_syntax_error(self):
+        shell = self.get_shell()
+        assert shell("echo (").exit_code() is None
+        assert shell("echo Foo") == "Foo"
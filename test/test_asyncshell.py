@@ -0,0 +1,111 @@
+from asyncio import run, gather
+from citizenshell import LocalShell, ShellError, ShellTimeout, tail
+from loopbackshell import LoopbackShell
+from pytest import mark, raises
+from time import time
+
+SHELLS = [LocalShell, LoopbackShell]
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_can_run_command(shell_class):
+    async def main():
+        result = await shell_class().run("echo Foo; echo Bar >&2; exit 3")
+        assert await result.stdout() == ["Foo"]
+        assert await result.stderr() == ["Bar"]
+        # NOTE: stdout and stderr are read separately, nothing orders one against the other
+        assert sorted(await result.combined()) == [(1, "Foo"), (2, "Bar")]
+        assert await result.exit_code() == 3
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_can_iterate_while_command_runs(shell_class):
+    async def main():
+        collected = []
+        result = await shell_class().run("for i in 1 2 3; do echo $i; sleep .2; done", wait=False)
+        async for line in result:
+            collected.append((time(), line))
+        assert [line for _, line in collected] == ["1", "2", "3"]
+        assert collected[-1][0] - collected[0][0] > 0.3
+        assert await result.exit_code() == 0
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_env_and_cwd(shell_class):
+    async def main():
+        shell = shell_class(FOO="foo")
+        assert await (await shell.run("echo $FOO $BAR", BAR="bar")).stdout() == ["foo bar"]
+        assert await (await shell.run("pwd", cwd="/")).stdout() == ["/"]
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_check_xc_and_check_err(shell_class):
+    async def main():
+        shell = shell_class()
+        with raises(ShellError):
+            await shell.run("exit 12", check_xc=True)
+        with raises(ShellError):
+            await shell.run("echo error >&2", check_err=True)
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_runs_commands_concurrently(shell_class):
+    async def main():
+        shell = shell_class()
+        start = time()
+        results = await gather(*[shell.run("sleep .5; echo %d" % i) for i in range(20)])
+        assert time() - start < 2
+        for i, result in enumerate(results):
+            assert await result.stdout() == [str(i)]
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_retain(shell_class):
+    async def main():
+        shell = shell_class()
+        result = await shell.run("for i in 1 2 3; do echo $i; done", wait=False, retain="none")
+        assert [line async for line in result] == ["1", "2", "3"]
+        assert await result.stdout() == []
+        assert await result.exit_code() == 0
+        result = await shell.run("for i in 1 2 3; do echo $i; done", retain=tail(1))
+        assert await result.stdout() == ["3"]
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_binary(shell_class):
+    async def main():
+        result = await shell_class().run("printf 'a\\000\\377b'", binary=True, chunk_size=2)
+        chunks = [chunk async for chunk in result.iter_chunks()]
+        assert all(len(chunk) <= 2 for chunk in chunks)
+        assert b"".join(chunks) == b"a\x00\xffb"
+    run(main())
+
+
+def test_async_local_shell_can_cancel_command():
+    async def main():
+        start = time()
+        result = await LocalShell().run("sleep 10; echo never", wait=False)
+        result.cancel()
+        assert await result.stdout() == []
+        assert await result.exit_code() == -9
+        assert time() - start < 5
+    run(main())
+
+
+@mark.parametrize("shell_class", SHELLS)
+def test_async_shell_command_timeout(shell_class):
+    async def main():
+        start = time()
+        with raises(ShellTimeout):
+            await shell_class().run("sleep 10", timeout=.5)
+        result = await shell_class().run("sleep 10", wait=False)
+        with raises(ShellTimeout):
+            await result.exit_code(.5)
+        assert time() - start < 5
+    run(main())
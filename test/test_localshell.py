@@ -1,9 +1,32 @@
-from os import environ
+from os import environ, path, listdir
+from threading import active_count
+from time import time
+from logging import Logger, INFO
+from io import BytesIO
+from pytest import mark, raises
+from backports.tempfile import TemporaryDirectory
+import tarfile
 
 from citizenshell import LocalShell, sh
 from shelltester import AbstractShellTester
 
 
+def hostile_member(kind):
+    if kind == "parent":
+        return [ tarfile.TarInfo("../escaped") ]
+    if kind == "symlink":
+        link = tarfile.TarInfo("link")
+        link.type, link.linkname = tarfile.SYMTYPE, path.join("..", "..")
+        return [ link, tarfile.TarInfo("link/escaped") ]
+    if kind == "absolute_symlink":
+        link = tarfile.TarInfo("link")
+        link.type, link.linkname = tarfile.SYMTYPE, "/"
+        return [ link ]
+    device = tarfile.TarInfo("device")
+    device.type = tarfile.CHRTYPE
+    return [ device ]
+
+
 class TestLocalShell(AbstractShellTester):
     def instanciate_new_shell(self, **kwargs):
         return LocalShell(**kwargs)
@@ -17,3 +40,73 @@ class TestLocalShell(AbstractShellTester):
     def test_local_shell_can_access_os_environ_by_default(self):
         shell_value = environ["SHELL"]
         assert sh("echo $SHELL") == shell_value
+
+    def test_local_shell_concurrent_commands_use_constant_thread_count(self):
+        shell = LocalShell()
+        shell("true")
+        thread_count = active_count()
+        results = [shell("sleep .2; echo %d; echo %d >&2; exit %d" % (i, i, i % 7), wait=False) for i in range(100)]
+        assert active_count() == thread_count
+        for i, result in enumerate(results):
+            assert result.stdout() == [str(i)]
+            assert result.stderr() == [str(i)]
+            assert result.exit_code() == i % 7
+
+    def test_local_shell_instances_share_loggers(self):
+        LocalShell(log_level=INFO)
+        logger_count = len(Logger.manager.loggerDict)
+        for _ in range(100):
+            LocalShell(log_level=INFO)("true")
+        assert len(Logger.manager.loggerDict) == logger_count
+
+    def test_local_shell_can_cancel_command(self):
+        shell = LocalShell()
+        start = time()
+        result = shell("sleep 10 | cat; echo never", wait=False)
+        result.cancel()
+        assert result.stdout() == []
+        assert result.exit_code() == -9
+        assert time() - start < 5
+
+    def test_local_shell_close_cancels_running_commands(self):
+        start = time()
+        with LocalShell() as shell:
+            results = [ shell("sleep 10; echo never", wait=False) for _ in range(5) ]
+        assert [ result.exit_code() for result in results ] == [-9] * 5
+        assert time() - start < 5
+
+    def test_local_shell_cancel_after_completion_does_nothing(self):
+        shell = LocalShell()
+        result = shell("echo Foo")
+        result.cancel()
+        assert result.exit_code() == 0
+        assert shell("echo Bar") == "Bar"
+
+    @mark.parametrize("kind", ["parent", "symlink", "absolute_symlink", "device"])
+    def test_local_shell_pull_tree_rejects_hostile_archive(self, kind):
+        shell = LocalShell()
+        with TemporaryDirectory() as sandbox:
+            archive_path = path.join(sandbox, "hostile.tar")
+            with tarfile.open(archive_path, "w") as archive:
+                for member in hostile_member(kind):
+                    archive.addfile(member, BytesIO(b"") if member.isreg() else None)
+            # NOTE: the target "sends" the hostile archive whatever the command
+            execute_command = shell.execute_command
+            shell.execute_command = lambda command, *args, **kwargs: \
+                execute_command("cat '%s'" % archive_path, *args, **kwargs)
+            local_path = path.join(sandbox, "pulled", "tree")
+            with raises(RuntimeError):
+                shell.pull_tree(local_path, "/anywhere", compress=False)
+            assert sorted(listdir(sandbox)) == ["hostile.tar", "pulled"]
+            assert listdir(path.join(sandbox, "pulled")) == ["tree"]
+
+    def test_local_shell_pull_tree_ignores_warnings(self):
+        shell = LocalShell()
+        with TemporaryDirectory() as sandbox:
+            open(path.join(sandbox, "text"), "w").write("this is a file\n")
+            execute_command = shell.execute_command
+            shell.execute_command = lambda command, *args, **kwargs: \
+                execute_command("echo 'tar: some warning' >&2; %s" % command, *args, **kwargs)
+            pulled = path.join(sandbox, "pulled")
+            shell.pull_tree(pulled, sandbox, compress=False)
+            assert open(path.join(pulled, "text")).read() == "this is a file\n"
@@ -0,0 +1,224 @@
+from loopbackshell import LoopbackShell
+from shelltester import AbstractShellTester
+from tempfile import NamedTemporaryFile
+from hashlib import md5
+from os import urandom, chmod, stat, listdir, path, environ
+from pytest import mark, raises
+from json import load, dump
+from sys import modules
+from threading import Thread
+from citizenshell.abstractremoteshell import save_capabilities
+
+
+def spy_commands(shell):
+    commands = []
+    execute_command = shell.execute_command
+    def spy(command, *args, **kwargs):
+        commands.append(command)
+        return execute_command(command, *args, **kwargs)
+    shell.execute_command = spy
+    return commands
+
+
+class TestLoopbackShell(AbstractShellTester):
+    def instanciate_new_shell(self, *args, **kwargs):
+        return LoopbackShell(*args, **kwargs)
+
+    @mark.parametrize("encoder", ["base64", "printf"])
+    def test_shell_can_push_binary_file(self, encoder):
+        shell = LoopbackShell()
+        shell._available_commands["base64"] = encoder
+        content = urandom(3 * shell.PUSH_BLOCK_SIZE * shell.PUSH_WINDOW_SIZE // 2 + 7) + b"CITIZENSHELL_EOF\n'\\%"
+        remote_path = self.get_test_remote_path(shell)
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            shell.do_push(temp_file.name, remote_path)
+        try:
+            assert shell.md5(remote_path) == md5(content).hexdigest()
+        finally:
+            shell("rm %s" % remote_path)
+
+    def test_shell_can_push_empty_file(self):
+        shell = LoopbackShell()
+        remote_path = self.get_test_remote_path(shell)
+        with NamedTemporaryFile() as temp_file:
+            shell.do_push(temp_file.name, remote_path)
+        try:
+            assert shell("test -f %s && ! test -s %s" % (remote_path, remote_path))
+        finally:
+            shell("rm %s" % remote_path)
+
+    @mark.parametrize("encoder", ["base64", "od"])
+    def test_shell_can_pull_binary_file_by_range(self, encoder):
+        shell = LoopbackShell()
+        shell._available_commands["base64"] = encoder
+        shell.PULL_RANGE_SIZE = 64 * 1024
+        content = urandom(5 * shell.PULL_RANGE_SIZE // 2) + b"\x00" * shell.PULL_RANGE_SIZE
+        with NamedTemporaryFile() as remote_file, NamedTemporaryFile() as local_file:
+            remote_file.write(content)
+            remote_file.flush()
+            shell.do_pull(local_file.name, remote_file.name)
+            assert open(local_file.name, "rb").read() == content
+
+    def test_shell_pull_of_missing_file_fails(self):
+        shell = LoopbackShell()
+        remote_path = self.get_test_remote_path(shell)
+        with NamedTemporaryFile() as local_file:
+            with raises(RuntimeError):
+                shell.do_pull(local_file.name, remote_path)
+
+    @mark.parametrize("compressor", ["xz", "gzip", None])
+    def test_shell_compresses_pushed_file(self, compressor):
+        shell = LoopbackShell()
+        shell._available_commands["xz"] = compressor
+        content = b"".join(b"line %d of a very compressible log\n" % i for i in range(50000))
+        remote_path = self.get_test_remote_path(shell)
+        commands = spy_commands(shell)
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            shell.do_push(temp_file.name, remote_path)
+        try:
+            assert shell.md5(remote_path) == md5(content).hexdigest()
+            pushed = sum(len(command) for command in commands)
+            if compressor:
+                assert any("| %s -dc >>" % compressor in command for command in commands)
+                assert pushed < len(content) / 10
+            else:
+                assert pushed > len(content)
+        finally:
+            shell("rm %s" % remote_path)
+
+    def test_shell_does_not_compress_random_data(self):
+        shell = LoopbackShell()
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(urandom(shell.PUSH_BLOCK_SIZE))
+            temp_file.flush()
+            assert shell.push_compressor(temp_file.name) is None
+            temp_file.seek(0)
+            temp_file.write(b"\x00" * shell.PUSH_BLOCK_SIZE)
+            temp_file.flush()
+            assert shell.push_compressor(temp_file.name) in ("xz", "gzip")
+
+    def test_shell_does_not_pick_xz_without_lzma(self, monkeypatch):
+        monkeypatch.setitem(modules, "lzma", None)
+        shell = LoopbackShell()
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(b"\x00" * shell.PUSH_BLOCK_SIZE)
+            temp_file.flush()
+            assert shell.push_compressor(temp_file.name) == "gzip"
+
+    @mark.parametrize("compressible", [True, False])
+    def test_shell_pulls_compressed_ranges(self, compressible):
+        shell = LoopbackShell()
+        content = b"compressible\n" * 300000 if compressible else urandom(300000)
+        shell.PULL_RANGE_SIZE = 64 * 1024
+        commands = spy_commands(shell)
+        with NamedTemporaryFile() as remote_file, NamedTemporaryFile() as local_file:
+            remote_file.write(content)
+            remote_file.flush()
+            shell.do_pull(local_file.name, remote_file.name)
+            assert open(local_file.name, "rb").read() == content
+        ranges = [ command for command in commands if " skip=" in command ]
+        compressed = [ command for command in ranges if "| gzip -c |" in command ]
+        if compressible:
+            assert compressed == ranges
+        else:
+            assert compressed == ranges[:1]
+
+    def test_shell_probes_commands_once_and_caches_them(self, capability_cache):
+        cache_path = capability_cache
+        shell = LoopbackShell()
+        commands = spy_commands(shell)
+        assert shell.get_command("md5sum", "md5") == "md5sum"
+        assert shell.get_command("base64", "uudecode", "printf") == "base64"
+        assert shell.get_command("uudecode", mandatory=False) is None
+        assert commands == []
+
+        with open(cache_path) as cache_file:
+            cache = load(cache_file)
+        entry = cache["LoopbackShell:localhost"]
+        assert entry["commands"]["base64"]
+        entry["commands"]["base64"] = False
+        with open(cache_path, "w") as cache_file:
+            dump(cache, cache_file)
+        assert LoopbackShell().get_command("base64", "od", "hexdump") == "od"
+
+        entry["fingerprint"] = "some other system"
+        with open(cache_path, "w") as cache_file:
+            dump(cache, cache_file)
+        assert LoopbackShell().get_command("base64", "od", "hexdump") == "base64"
+        with open(cache_path) as cache_file:
+            assert load(cache_file)["LoopbackShell:localhost"]["commands"]["base64"]
+
+    def test_shell_is_not_connected_when_the_probe_fails(self):
+        shell = LoopbackShell()
+        shell.disconnect()
+        shell.probe_commands = lambda: 1 / 0
+        with raises(ZeroDivisionError):
+            shell.connect()
+        assert not shell.is_connected()
+
+    def test_shell_capability_cache_survives_concurrent_saves(self, capability_cache):
+        def save(i):
+            save_capabilities(capability_cache, "target%d" % i, "fingerprint", { "base64": True })
+        threads = [ Thread(target=save, args=(i,)) for i in range(20) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(capability_cache) as cache_file:
+            assert load(cache_file)
+        assert listdir(path.dirname(capability_cache)) == [ path.basename(capability_cache) ]
+
+    @mark.parametrize("tool", ["stat -c", "find -printf", "ls"])
+    def test_shell_stat_many_fallbacks(self, tool):
+        shell = LoopbackShell()
+        shell._available_commands["stat -c"] = tool
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(b"content")
+            temp_file.flush()
+            chmod(temp_file.name, 0o4751)
+            stats = shell.stat_many([temp_file.name, "/tmp", temp_file.name + ".missing"], md5=True)
+            assert stats[temp_file.name].size == 7
+            assert stats[temp_file.name].mode == 0o4751
+            assert stats[temp_file.name].type == "file"
+            assert stats[temp_file.name].md5 == md5(b"content").hexdigest()
+            assert stats[temp_file.name].mtime == (None if tool == "ls" else int(stat(temp_file.name).st_mtime))
+            assert stats["/tmp"].type == "directory"
+            assert stats[temp_file.name + ".missing"] is None
+
+    @mark.parametrize("flavour,tool", [ (["stat"], "find -printf"), (["stat", "find"], "ls") ])
+    def test_shell_stat_many_with_bsd_tools(self, flavour, tool, monkeypatch, tmp_path):
+        # NOTE: BSD stat and find exist but know neither -c nor -printf
+        for command in flavour:
+            fake = tmp_path / command
+            fake.write_text("#!/bin/sh\necho \"%s: illegal option\" >&2\nexit 1\n" % command)
+            chmod(str(fake), 0o755)
+        monkeypatch.setenv("PATH", "%s:%s" % (tmp_path, environ["PATH"]))
+        shell = LoopbackShell()
+        assert shell.get_command("stat -c", "find -printf", "ls") == tool
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(b"content")
+            temp_file.flush()
+            stats = shell.stat_many([temp_file.name], md5=True)
+            assert stats[temp_file.name].size == 7
+            assert stats[temp_file.name].md5 == md5(b"content").hexdigest()
+
+    def test_shell_push_and_pull_do_not_spend_round_trips_on_permissions(self):
+        shell = LoopbackShell()
+        remote_path = self.get_test_remote_path(shell)
+        commands = spy_commands(shell)
+        with NamedTemporaryFile() as temp_file:
+            temp_file.write(b"content")
+            temp_file.flush()
+            chmod(temp_file.name, 0o751)
+            shell.push(temp_file.name, remote_path)
+            assert len(commands) == 3  # truncate, blocks, permissions and verification
+            assert shell.get_permissions(remote_path) == 0o751
+            del commands[:]
+            shell.pull(temp_file.name, remote_path)
+            assert len(commands) == 2  # metadata and md5, content
+            assert stat(temp_file.name).st_mode & 0o7777 == 0o751
+        shell("rm %s" % remote_path)
@@ -1,10 +1,17 @@
-from pytest import skip
-from citizenshell import SecureShell
+from pytest import skip, raises
+from paramiko import SFTPClient, SSHException
+from citizenshell import SecureShell, secureshell
 from shelltester import AbstractShellTester
-from os import environ
+from fakesshserver import FakeSshServer, USERNAME, PASSWORD
+from concurrent.futures import ThreadPoolExecutor
+from backports.tempfile import TemporaryDirectory
+from os import environ, path, urandom
+from time import time, sleep
 
 
 class TestSecureShell(AbstractShellTester):
+    CONCURRENT = True
+
     def setup_method(self):
         if "TEST_SSH_HOST" not in environ:
             skip("need to define TEST_SSH_HOST environment variable")
@@ -17,3 +24,160 @@ class TestSecureShell(AbstractShellTester):
         return SecureShell(
             hostname, username=username, password=password, port=port, *args, **kwargs
         )
+
+    def test_shell_can_be_shared_between_threads(self):
+        shell = self.get_shell()
+        def run(i):
+            assert shell.get_command("base64", "od")
+            result = shell("sleep .1; echo %d; exit %d" % (i, i % 3))
+            return (result.stdout(), result.exit_code())
+        start = time()
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            outcomes = list(executor.map(run, range(20)))
+        assert outcomes == [ ([str(i)], i % 3) for i in range(20) ]
+        if self.CONCURRENT:
+            assert time() - start < 1.5
+
+    def test_shell_queues_commands_beyond_server_max_sessions(self):
+        shell = self.instanciate_new_shell(max_sessions=100)
+        results = [ shell("sleep .2; echo %d" % i, wait=False) for i in range(40) ]
+        for i, result in enumerate(results):
+            assert result.stdout() == [str(i)]
+            assert result.exit_code() == 0
+        shell.disconnect()
+
+
+    def test_shell_sftp_transfer_reports_progress(self):
+        reported = []
+        shell = self.instanciate_new_shell(sftp_requests=4, progress=lambda *args: reported.append(args))
+        remote_path = self.get_test_remote_path(shell)
+        content = urandom(1024 * 1024 + 123)
+        try:
+            with TemporaryDirectory() as sandbox:
+                local_path = path.join(sandbox, "pushed")
+                open(local_path, "wb").write(content)
+                shell.push(local_path, remote_path)
+                assert reported[-1] == (remote_path, len(content), len(content))
+                assert len(reported) > 1
+                del reported[:]
+                shell.pull(path.join(sandbox, "pulled"), remote_path)
+                assert reported[-1] == (remote_path, len(content), len(content))
+                assert open(path.join(sandbox, "pulled"), "rb").read() == content
+        finally:
+            shell("rm -f %s" % remote_path)
+            shell.disconnect()
+
+    def test_shell_falls_back_to_scp(self):
+        shell = self.instanciate_new_shell()
+        shell._sftp_available = False
+        remote_path = self.get_test_remote_path(shell)
+        try:
+            with TemporaryDirectory() as sandbox:
+                open(path.join(sandbox, "pushed"), "wb").write(b"content")
+                shell.push_many([ (path.join(sandbox, "pushed"), remote_path) ])
+                shell.pull(path.join(sandbox, "pulled"), remote_path)
+                assert open(path.join(sandbox, "pulled"), "rb").read() == b"content"
+        finally:
+            shell("rm -f %s" % remote_path)
+            shell.disconnect()
+
+
+class TestSecureShellPersistent(TestSecureShell):
+    CONCURRENT = False
+
+    def test_shell_queues_commands_beyond_server_max_sessions(self):
+        skip("a persistent shell runs every command on the same channel")
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return super(TestSecureShellPersistent, self).instanciate_new_shell(persistent=True, *args, **kwargs)
+
+    def test_shell_survives_syntax_error(self):
+        shell = self.get_shell()
+        assert shell("echo (").exit_code() is None
+        assert shell("echo Foo") == "Foo"
+
+
+class TestSecureShellServer(TestSecureShell):
+
+    @classmethod
+    def setup_class(cls):
+        cls.server = FakeSshServer()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setup_method(self):
+        pass
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return SecureShell("localhost", username=USERNAME, password=PASSWORD, port=self.server.port(), *args, **kwargs)
+
+    def test_shell_falls_back_to_scp_when_sftp_is_refused(self):
+        server = FakeSshServer(sftp=False)
+        try:
+            shell = SecureShell("localhost", username=USERNAME, password=PASSWORD, port=server.port())
+            with TemporaryDirectory() as sandbox:
+                open(path.join(sandbox, "pushed"), "wb").write(b"content")
+                shell.push(path.join(sandbox, "pushed"), path.join(sandbox, "remote"))
+                shell.pull(path.join(sandbox, "pulled"), path.join(sandbox, "remote"))
+                assert open(path.join(sandbox, "pulled"), "rb").read() == b"content"
+            assert not shell._sftp_available
+            shell.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_shell_keeps_sftp_after_a_failed_negotiation(self, monkeypatch):
+        shell = self.instanciate_new_shell()
+        failures = [ SSHException("EOF during negotiation") ]
+        def flaky_client(channel):
+            if failures:
+                raise failures.pop()
+            return SFTPClient(channel)
+        monkeypatch.setattr(secureshell, "SFTPClient", flaky_client)
+        with TemporaryDirectory() as sandbox:
+            open(path.join(sandbox, "pushed"), "wb").write(b"content")
+            with raises(SSHException):
+                shell.push(path.join(sandbox, "pushed"), path.join(sandbox, "remote"))
+            assert shell._sftp_available
+            shell.push(path.join(sandbox, "pushed"), path.join(sandbox, "remote"))
+            assert open(path.join(sandbox, "remote"), "rb").read() == b"content"
+        shell.disconnect()
+
+    def test_shell_recovers_the_session_limit(self):
+        server = FakeSshServer(max_sessions=2)
+        try:
+            shell = SecureShell("localhost", username=USERNAME, password=PASSWORD, port=server.port())
+            results = [ shell("sleep .2; echo %d" % i, wait=False) for i in range(4) ]
+            assert [ result.stdout() for result in results ] == [ [str(i)] for i in range(4) ]
+            assert server.refused > 0
+            server.max_sessions = 4
+            sleep(1.2)
+            start = time()
+            results = [ shell("sleep .5", wait=False) for i in range(4) ]
+            assert all(result.exit_code() == 0 for result in results)
+            assert time() - start < .9
+            shell.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestSecureShellServerPersistent(TestSecureShellServer):
+    CONCURRENT = False
+
+    def test_shell_queues_commands_beyond_server_max_sessions(self):
+        skip("a persistent shell runs every command on the same channel")
+
+    def test_shell_recovers_the_session_limit(self):
+        skip("a persistent shell runs every command on the same channel")
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return super(TestSecureShellServerPersistent, self).instanciate_new_shell(persistent=True, *args, **kwargs)
+
+    def test_shell_survives_syntax_error(self):
+        shell = self.get_shell()
+        assert shell("echo (").exit_code() is None
+        assert shell("echo Foo") == "Foo"
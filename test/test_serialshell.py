@@ -2,6 +2,7 @@ from os import environ
 from pytest import skip
 from citizenshell import SerialShell
 from shelltester import AbstractShellTester
+from fakeconsole import FakeConsole
 
 
 class TestSerialShell(AbstractShellTester):
@@ -23,3 +24,21 @@ class TestSerialShell(AbstractShellTester):
             **kwargs
         )
         return result
+
+
+class TestSerialShellConsole(TestSerialShell):
+
+    @classmethod
+    def setup_class(cls):
+        cls.console = FakeConsole()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.console.shutdown()
+        cls.console.server_close()
+
+    def setup_method(self):
+        pass
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return SerialShell(port=self.console.url(), *args, **kwargs)
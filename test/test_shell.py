@@ -8,6 +8,8 @@ from citizenshell import (
     ShellError,
 )
 from pytest import mark, raises
+from subprocess import check_output
+from sys import executable
 
 try:
     from urllib.parse import quote_plus
@@ -17,6 +19,25 @@ except:
 ###################################################################################################
 
 
+def test_import_does_not_load_backends():
+    script = "import citizenshell, sys; print(' '.join(sorted(sys.modules)))"
+    modules = check_output([executable, "-c", script]).decode().split()
+    for module in ("paramiko", "scp", "serial", "telnetlib", "uritools", "termcolor",
+                   "citizenshell.secureshell", "citizenshell.telnetshell",
+                   "citizenshell.adbshell", "citizenshell.serialshell"):
+        assert module not in modules
+
+
+def test_backends_and_default_shell_are_loaded_on_first_use():
+    import citizenshell
+    assert citizenshell.SecureShell is SecureShell
+    assert citizenshell.sh is citizenshell.sh
+    assert citizenshell.sh("echo Hello") == "Hello"
+    with raises(AttributeError):
+        citizenshell.NoSuchShell
+    assert "SerialShell" in dir(citizenshell)
+
+
 def test_localshell_by_uri():
     shell = Shell()
     assert isinstance(shell, LocalShell)
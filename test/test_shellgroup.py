@@ -0,0 +1,106 @@
+from citizenshell import ShellGroup, ShellPool, LocalShell, ShellError, fanout
+from loopbackshell import LoopbackShell
+from os import environ
+from pytest import mark
+from time import time, sleep
+
+
+def test_shell_group_runs_on_every_target():
+    shells = [ LocalShell(INDEX=str(i)) for i in range(5) ]
+    result = ShellGroup(shells)("echo out $INDEX; echo err $INDEX >&2; exit $INDEX")
+    results = result.results()
+    assert list(results) == [ shell.id() for shell in shells ]
+    for i, shell in enumerate(shells):
+        assert results[shell.id()].stdout() == ["out %d" % i]
+        assert results[shell.id()].stderr() == ["err %d" % i]
+        assert results[shell.id()].exit_code() == i
+    assert result.succeeded() == [shells[0].id()]
+
+
+def test_shell_group_streams_host_tagged_lines():
+    shells = [ LoopbackShell(INDEX=str(i)) for i in range(3) ]
+    result = ShellGroup(shells)("echo $INDEX; echo err >&2", wait=False)
+    collected = sorted(result.iter_combined())
+    assert collected == sorted([ (shell.id(), 1, str(i)) for i, shell in enumerate(shells) ] +
+                               [ (shell.id(), 2, "err") for shell in shells ])
+    assert sorted(result) == sorted([ (shell.id(), str(i)) for i, shell in enumerate(shells) ])
+
+
+def test_shell_group_scales_with_slowest_target():
+    shells = [ LoopbackShell(latency=.1) for _ in range(20) ]
+    start = time()
+    result = ShellGroup(shells)("sleep .5")
+    assert time() - start < 2
+    assert len(result.succeeded()) == 20
+
+
+def test_shell_group_bounds_the_number_of_workers():
+    shells = [ LocalShell() for _ in range(4) ]
+    start = time()
+    ShellGroup(shells, max_workers=2)("sleep .3").wait()
+    assert time() - start >= .6
+
+
+def test_shell_group_timeout():
+    fast, slow = LocalShell(), LocalShell()
+    start = time()
+    result = ShellGroup([slow, fast], timeout=.5, max_workers=1)("if [ -n \"$SLOW\" ]; then sleep 5; fi; echo done", SLOW="")
+    assert result.succeeded() == [slow.id(), fast.id()]
+    slow["SLOW"] = "1"
+    result = ShellGroup([slow, fast], timeout=.5, max_workers=1)("if [ -n \"$SLOW\" ]; then sleep 5; fi; echo done")
+    results = result.results()
+    assert time() - start < 3
+    assert isinstance(results[slow.id()], ShellError)
+    assert results[fast.id()].stdout() == ["done"]
+
+
+def test_shell_group_timeout_discards_pooled_shell():
+    pool = ShellPool()
+    result = ShellGroup(["local://"], timeout=.5, pool=pool)("sleep 5")
+    assert isinstance(result["local://"], ShellError)
+    with pool.shell("local://") as shell:
+        assert shell("echo Hello") == "Hello"
+    assert pool._counts[pool.key("local://")] == 1
+    assert not pool._acquired
+
+
+def test_shell_group_timeout_without_consumer():
+    fast, slow = LocalShell(), LocalShell(SLOW="1")
+    result = ShellGroup([slow, fast], timeout=.5)("if [ -n \"$SLOW\" ]; then sleep 5; fi; echo done", wait=False)
+    sleep(1)
+    assert result.timed_out(slow.id())
+    assert isinstance(result[slow.id()], ShellError)
+    assert result[fast.id()].stdout() == ["done"]
+
+
+def test_shell_group_check_xc():
+    shell = LocalShell()
+    result = ShellGroup([shell])("exit 3", check_xc=True)
+    assert isinstance(result[shell.id()], ShellError)
+    assert result.failed() == [shell.id()]
+
+
+def test_fanout_by_uri():
+    result = fanout(["local://"], "echo Hello")
+    assert result["local://"].stdout() == ["Hello"]
+
+
+def test_fanout_with_shell_kwargs():
+    result = fanout(["local://"], "echo $FOO $BAR", shell_kwargs={"FOO": "shell"}, BAR="command")
+    assert result["local://"].stdout() == ["shell command"]
+
+
+TEST_SSH_HOST_NOT_AVAILABLE = environ.get("TEST_SSH_HOST", None) is None
+
+
+@mark.skipif(TEST_SSH_HOST_NOT_AVAILABLE, reason="test host not available")
+def test_shell_group_with_pool():
+    uri = "ssh://%s:%s@%s:%d" % (environ.get("TEST_SSH_USER"), environ.get("TEST_SSH_PASS"),
+                                 environ.get("TEST_SSH_HOST"), int(environ.get("TEST_SSH_PORT", 22)))
+    pool = ShellPool()
+    group = ShellGroup([uri, "local://"], pool=pool)
+    for _ in range(2):
+        result = group("echo Hello")
+        assert result[uri].stdout() == ["Hello"]
+        assert result["local://"].stdout() == ["Hello"]
+    pool.close()
@@ -0,0 +1,136 @@
+from citizenshell import ShellPool, LocalShell, SecureShell
+from threading import Thread
+from os import environ
+from pytest import mark, raises
+from time import sleep, time
+
+
+def test_shell_pool_reuses_shells():
+    pool = ShellPool()
+    with pool.shell() as shell:
+        assert isinstance(shell, LocalShell)
+        assert shell("echo Hello") == "Hello"
+    with pool.shell("local://") as other:
+        assert other is shell
+
+
+def test_shell_pool_keys_on_options():
+    pool = ShellPool()
+    with pool.shell(FOO="foo") as shell:
+        assert shell("echo $FOO") == "foo"
+    with pool.shell(FOO="bar") as other:
+        assert other is not shell
+        assert other("echo $FOO") == "bar"
+
+
+def test_shell_pool_caps_shells_per_target():
+    pool = ShellPool(max_per_target=2)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    with raises(RuntimeError):
+        pool.acquire(timeout=.1)
+    Thread(target=lambda: (sleep(.2), pool.release(first))).start()
+    start = time()
+    assert pool.acquire(timeout=2) is first
+    assert time() - start >= .1
+
+
+def test_shell_pool_replaces_unhealthy_shells():
+    pool = ShellPool()
+    with pool.shell() as shell:
+        pass
+    def broken(*args, **kwargs):
+        raise RuntimeError("connection lost")
+    shell.execute_command = broken
+    with pool.shell() as other:
+        assert other is not shell
+        assert other("echo Hello") == "Hello"
+
+
+def test_shell_pool_discard():
+    pool = ShellPool(max_per_target=1)
+    shell = pool.acquire()
+    pool.discard(shell)
+    assert pool.acquire(timeout=.1) is not shell
+
+
+def test_shell_pool_evicts_idle_shells():
+    pool = ShellPool(idle_timeout=.1)
+    with pool.shell() as shell:
+        pass
+    sleep(.2)
+    pool.evict_idle()
+    with pool.shell() as other:
+        assert other is not shell
+
+
+def test_shell_pool_evicts_idle_shells_on_acquire():
+    pool = ShellPool(idle_timeout=.1)
+    with pool.shell() as shell:
+        pass
+    with pool.shell(FOO="foo"):
+        pass
+    sleep(.2)
+    with pool.shell(FOO="foo"):
+        pass
+    assert not pool._idle[pool.key()]
+
+
+def test_shell_pool_rejects_double_release():
+    pool = ShellPool()
+    shell = pool.acquire()
+    pool.release(shell)
+    with raises(RuntimeError):
+        pool.release(shell)
+    first, second = pool.acquire(), pool.acquire()
+    assert first is not second
+
+
+def test_shell_pool_rejects_foreign_shells():
+    pool = ShellPool()
+    with raises(RuntimeError):
+        pool.release(LocalShell())
+    with raises(RuntimeError):
+        pool.discard(LocalShell())
+
+
+def test_shell_pool_close_closes_shells_in_use():
+    pool = ShellPool()
+    shell = pool.acquire()
+    closed = []
+    shell.close = lambda: closed.append(shell)
+    pool.close()
+    assert closed == []
+    with raises(RuntimeError):
+        pool.acquire()
+    pool.release(shell)
+    assert closed == [shell]
+
+
+def test_shell_pool_close_wakes_up_waiting_callers():
+    pool = ShellPool(max_per_target=1)
+    pool.acquire()
+    Thread(target=lambda: (sleep(.2), pool.close())).start()
+    start = time()
+    with raises(RuntimeError):
+        pool.acquire(timeout=5)
+    assert time() - start < 2
+
+
+TEST_SSH_HOST_NOT_AVAILABLE = environ.get("TEST_SSH_HOST", None) is None
+
+
+@mark.skipif(TEST_SSH_HOST_NOT_AVAILABLE, reason="test host not available")
+def test_shell_pool_reuses_ssh_connection():
+    uri = "ssh://%s:%s@%s:%d" % (environ.get("TEST_SSH_USER"), environ.get("TEST_SSH_PASS"),
+                                 environ.get("TEST_SSH_HOST"), int(environ.get("TEST_SSH_PORT", 22)))
+    pool = ShellPool()
+    with pool.shell(uri) as shell:
+        assert isinstance(shell, SecureShell)
+        assert shell("echo Hello") == "Hello"
+    with pool.shell(uri) as other:
+        assert other is shell
+        assert other("echo World") == "World"
+    pool.close()
+    assert not shell.is_connected()
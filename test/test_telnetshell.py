@@ -2,6 +2,7 @@ from os import environ
 from pytest import skip
 from citizenshell import TelnetShell
 from shelltester import AbstractShellTester
+from fakeconsole import FakeConsole, USERNAME, PASSWORD
 
 
 class TestTelnetShell(AbstractShellTester):
@@ -17,3 +18,21 @@ class TestTelnetShell(AbstractShellTester):
         return TelnetShell(
             hostname, username=username, password=password, port=port, *args, **kwargs
         )
+
+
+class TestTelnetShellConsole(TestTelnetShell):
+
+    @classmethod
+    def setup_class(cls):
+        cls.console = FakeConsole(login=True)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.console.shutdown()
+        cls.console.server_close()
+
+    def setup_method(self):
+        pass
+
+    def instanciate_new_shell(self, *args, **kwargs):
+        return TelnetShell("localhost", username=USERNAME, password=PASSWORD, port=self.console.port(), *args, **kwargs)